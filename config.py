@@ -1,27 +1,39 @@
 # config.py
 import os
+from functools import lru_cache
+from typing import NamedTuple
 
-DATABASE_PATH = "chat_history.db"
+# Для тестов и локальных запусков можно указать ":memory:" или URI вида "file::memory:?cache=shared"
+DATABASE_PATH = os.environ.get("CHATBOT_DB_PATH", "chat_history.db")
 MAX_MESSAGE_LENGTH = 4096
 MEDIA_DIR = "generated_media"
 VOICES_DIR = os.path.join(MEDIA_DIR, "voices")
 VARIATIONS_DIR = os.path.join(MEDIA_DIR, "variations")
 IMAGES_DIR = os.path.join(MEDIA_DIR, "images")
+# Кэш синтезированной речи: MP3 по хэшу (голос, текст); при запуске старые файлы сверх лимита удаляются
+TTS_CACHE_DIR = os.path.join(VOICES_DIR, "tts_cache")
+TTS_CACHE_MAX_BYTES = 1024 ** 3
 
-# Создание директорий, если они не существуют
-for directory in [MEDIA_DIR, IMAGES_DIR, VOICES_DIR, VARIATIONS_DIR]:
-    os.makedirs(directory, exist_ok=True)
+@lru_cache(maxsize=None)
+def ensure_dir(path: str) -> str:
+    """Создаёт директорию при первом обращении (один mkdir на путь за время жизни процесса)."""
+    os.makedirs(path, exist_ok=True)
+    return path
 
-AVAILABLE_MODELS = [
-    ("gpt-4", "g4f"),
-    ("gpt-4o", "g4f"),
-    ("gpt-4o-mini", "g4f"),
-    ("gemini-1.5-pro", "g4f"),
-    ("deepseek-v3", "g4f"),
-    ("deepseek-r1", "g4f"),
-    ("sonar-pro", "g4f"),
-    ("sonar-reasoning-pro", "g4f"),
-]
+class Model(NamedTuple):
+    name: str
+    provider: str
+
+AVAILABLE_MODELS: tuple[Model, ...] = (
+    Model("gpt-4", "g4f"),
+    Model("gpt-4o", "g4f"),
+    Model("gpt-4o-mini", "g4f"),
+    Model("gemini-1.5-pro", "g4f"),
+    Model("deepseek-v3", "g4f"),
+    Model("deepseek-r1", "g4f"),
+    Model("sonar-pro", "g4f"),
+    Model("sonar-reasoning-pro", "g4f"),
+)
 DEFAULT_MODEL = "gpt-4o"
 DEFAULT_VOICE = "ru-RU-SvetlanaNeural"  # Голос по умолчанию для русского языка
 ENGLISH_VOICE = "en-US-AriaNeural"     # Голос для английского языка
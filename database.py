@@ -1,23 +1,170 @@
 # database.py
+import os
+import asyncio
+import hashlib
 import aiosqlite
 import logging
+from contextlib import asynccontextmanager
 from config import AVAILABLE_MODELS
 
 logger = logging.getLogger(__name__)
 
+# Упорядоченный список миграций: (версия, SQL). Применённые версии хранятся в schema_migrations
+MIGRATIONS = (
+    (1, "ALTER TABLE profiles ADD COLUMN audio_requests INTEGER DEFAULT 0"),
+    (2, "ALTER TABLE profiles ADD COLUMN created_at TEXT"),
+    # Заполняем created_at для записей, созданных до добавления DEFAULT или исправления логики.
+    # Выполняется один раз; на последующих запусках UPDATE и SELECT changes() не выполняются
+    (3, "UPDATE profiles SET created_at = datetime('now', 'localtime') WHERE created_at IS NULL"),
+    # Индексы под типичные запросы: последние сообщения сессии, статистика пользователя, активные модели
+    (4, "CREATE INDEX IF NOT EXISTS idx_history_user_session_ts ON history(user_id, session_id, timestamp DESC)"),
+    (5, "CREATE INDEX IF NOT EXISTS idx_user_stats_user_date ON user_stats(user_id, date)"),
+    (6, "CREATE INDEX IF NOT EXISTS idx_models_active ON models(is_active) WHERE is_active = 1"),
+    # Счётчик сессий пользователя вместо MAX(session_id) по истории
+    (7, "ALTER TABLE profiles ADD COLUMN next_session_id INTEGER DEFAULT 1"),
+    (8, """UPDATE profiles SET next_session_id = COALESCE(
+            (SELECT MAX(session_id) FROM history WHERE history.user_id = profiles.user_id), 0) + 1"""),
+    # Контекст сессии читается с конца по id: индекс отдаёт последние 10 строк без сортировки.
+    # Индекс по timestamp после этого не нужен и только замедляет вставки
+    (9, "CREATE INDEX IF NOT EXISTS idx_history_user_session_id ON history(user_id, session_id, id DESC)"),
+    (10, "DROP INDEX IF EXISTS idx_history_user_session_ts"),
+    # Сводная статистика по дням для админки пополняется при записи; заполняем её из уже накопленной user_stats
+    (11, """INSERT OR IGNORE INTO user_stats_daily (date, action_type, model_name, total_count)
+            SELECT date, action_type, model_name, SUM(count) FROM user_stats
+            GROUP BY date, action_type, model_name"""),
+    (12, "CREATE INDEX IF NOT EXISTS idx_user_stats_daily_date ON user_stats_daily(date DESC, action_type, model_name)"),
+    # Время последнего запроса хранится в профиле, чтобы список активности не соединял profiles с user_stats.
+    # Для существующих пользователей берём время последней записи в истории (timestamp хранится в UTC)
+    (13, "ALTER TABLE profiles ADD COLUMN last_activity TEXT"),
+    (14, """UPDATE profiles SET last_activity = (
+            SELECT datetime(MAX(timestamp), 'localtime') FROM history WHERE history.user_id = profiles.user_id)
+            WHERE last_activity IS NULL"""),
+    (15, "CREATE INDEX IF NOT EXISTS idx_profiles_last_activity ON profiles(last_activity DESC)"),
+    # UPSERT в user_stats и выборки по (user_id, date) обслуживает индекс первичного ключа
+    # (user_id, date, action_type, model_name); отдельный индекс по его префиксу только замедляет запись
+    (16, "DROP INDEX IF EXISTS idx_user_stats_user_date"),
+)
+
+# Версия схемы хранится в PRAGMA user_version; при совпадении init_db пропускает DDL
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# PRAGMA, которые действуют в пределах одного соединения и применяются ко всем соединениям пула
+CONNECTION_PRAGMAS = """
+    PRAGMA foreign_keys = ON;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -65536;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA busy_timeout = 5000;
+"""
+
+class ConnectionPool:
+    """Пул соединений: одно соединение на запись и N соединений только для чтения.
+    Читатели выдаются через asyncio.Queue, писатель сериализуется asyncio.Lock.
+    """
+    def __init__(self, path, readers=None):
+        self.path = path
+        self.uri = path.startswith("file:")
+        # In-memory базу видит только открывшее её соединение: читатели не создаются,
+        # чтение идёт через соединение на запись
+        self.in_memory = path == ":memory:" or "mode=memory" in path or path.startswith("file::memory:")
+        self.size = 0 if self.in_memory else (readers or min(os.cpu_count() or 1, 4))
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._readers = None
+        self._all_readers = []
+
+    async def _configure(self, connection):
+        # Строки возвращаются обычными кортежами: все запросы бота распаковывают их по позиции.
+        # Если нужен доступ по имени колонки, задайте cursor.row_factory = aiosqlite.Row локально
+        await connection.executescript(CONNECTION_PRAGMAS)
+
+    async def open(self):
+        # Писатель открывается первым: он создаёт файл БД и переводит его в WAL,
+        # иначе читатели с mode=ro не смогут работать параллельно с записью
+        self._writer = await aiosqlite.connect(self.path, uri=self.uri)
+        # WAL не поддерживается для in-memory баз, журнал держим в памяти
+        wanted_mode = "memory" if self.in_memory else "wal"
+        async with self._writer.execute(f"PRAGMA journal_mode = {wanted_mode}") as cursor:
+            (journal_mode,) = await cursor.fetchone()
+        if journal_mode.lower() != wanted_mode:
+            # Например, на сетевых файловых системах WAL недоступен
+            logger.warning(f"SQLite WAL mode is unavailable, using journal_mode={journal_mode}")
+        await self._configure(self._writer)
+        await self._writer.commit()
+
+        self._readers = asyncio.Queue()
+        if self.uri:
+            reader_uri = f"{self.path}{'&' if '?' in self.path else '?'}mode=ro"
+        else:
+            reader_uri = f"file:{self.path}?mode=ro"
+        for _ in range(self.size):
+            reader = await aiosqlite.connect(reader_uri, uri=True)
+            await self._configure(reader)
+            self._all_readers.append(reader)
+            self._readers.put_nowait(reader)
+        logger.info(f"Opened SQLite pool: 1 writer + {self.size} readers")
+
+    @property
+    def writer_connection(self):
+        return self._writer
+
+    @asynccontextmanager
+    async def reader(self):
+        if not self.size:
+            yield self._writer
+            return
+        connection = await self._readers.get()
+        try:
+            yield connection
+        finally:
+            self._readers.put_nowait(connection)
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._writer_lock:
+            yield self._writer
+
+    async def close(self):
+        for reader in self._all_readers:
+            await reader.close()
+        self._all_readers.clear()
+        if self._writer:
+            await self._writer.close()
+            self._writer = None
+
 class Database:
-    def __init__(self, path):
+    def __init__(self, path, readers=None):
         self.path = path
+        self.pool = ConnectionPool(path, readers)
         self.connection = None
 
     async def connect(self):
-        self.connection = await aiosqlite.connect(self.path)
-        self.connection.row_factory = aiosqlite.Row
-        await self.connection.execute("PRAGMA foreign_keys = ON")
-        await self.connection.commit()
+        await self.pool.open()
+        # Соединение на запись; используется init_db и доступно через writer()
+        self.connection = self.pool.writer_connection
+
+    def reader(self):
+        """Соединение только для чтения из пула: `async with db.reader() as conn`."""
+        return self.pool.reader()
+
+    def writer(self):
+        """Единственное соединение на запись, захватывается эксклюзивно."""
+        return self.pool.writer()
 
     async def init_db(self):
+        async with self.connection.execute("PRAGMA user_version") as cursor:
+            (user_version,) = await cursor.fetchone()
+        if user_version == SCHEMA_VERSION:
+            logger.info(f"Database schema is up to date (version {user_version}), skipping init")
+        else:
+            await self._migrate(user_version)
+        await self._sync_models()
+
+    async def _migrate(self, user_version):
         async with self.connection.cursor() as cursor:
+            # Вся миграция выполняется одной транзакцией: один сброс журнала вместо десятка
+            await cursor.execute("BEGIN IMMEDIATE")
             # Create profiles table if it doesn't exist
             await cursor.execute("""
                 CREATE TABLE IF NOT EXISTS profiles (
@@ -26,7 +173,9 @@ class Database:
                     gpt_requests INTEGER DEFAULT 0,
                     image_requests INTEGER DEFAULT 0,
                     audio_requests INTEGER DEFAULT 0,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    next_session_id INTEGER DEFAULT 1,
+                    last_activity TEXT
                 )
             """)
 
@@ -69,42 +218,76 @@ class Database:
                     FOREIGN KEY (user_id) REFERENCES profiles(user_id)
                 )
             """)
+            # Статистика по всем пользователям за день, чтобы админке не агрегировать user_stats при каждом просмотре
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS user_stats_daily (
+                    date TEXT,
+                    action_type TEXT,
+                    model_name TEXT,
+                    total_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (date, action_type, model_name)
+                )
+            """)
+            # Служебные значения (например, хэш списка моделей)
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
 
-            # Check and add missing columns in 'profiles'
-            await cursor.execute("PRAGMA table_info(profiles)")
-            columns = [row['name'] for row in await cursor.fetchall()]
-
-            if 'audio_requests' not in columns:
-                await cursor.execute("ALTER TABLE profiles ADD COLUMN audio_requests INTEGER DEFAULT 0")
-                logger.info("Added audio_requests column to profiles table")
-
-            if 'created_at' not in columns:
-                await cursor.execute("ALTER TABLE profiles ADD COLUMN created_at TEXT")
-                logger.info("Added created_at column to profiles table")
-            
-            # Всегда пытаемся обновить существующие записи, где created_at IS NULL.
-            # Это важно для данных, которые могли быть созданы до добавления DEFAULT или исправления логики.
-            await self.connection.execute("UPDATE profiles SET created_at = datetime('now', 'localtime') WHERE created_at IS NULL")
-            async with self.connection.execute("SELECT changes()") as changes_cursor:
-                updated_rows = await changes_cursor.fetchone()
-                if updated_rows and updated_rows[0] > 0:
-                    logger.info(f"Backfilled 'created_at' for {updated_rows[0]} profiles that had NULL.")
-            
-            # Коммит нужен после DML операций, таких как UPDATE
-            await self.connection.commit()
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    applied_at TEXT DEFAULT (datetime('now', 'localtime'))
+                )
+            """)
 
-            for model_name, provider in AVAILABLE_MODELS:
+            # Применяем только миграции новее последней записанной версии
+            await cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            (applied_version,) = await cursor.fetchone()
+            for version, statement in MIGRATIONS:
+                if version <= applied_version:
+                    continue
                 try:
-                    await self.connection.execute(
-                        "INSERT OR IGNORE INTO models (name, provider) VALUES (?, ?)",
-                        (model_name, provider)
-                    )
-                except Exception as e:
-                    logger.error(f"Error inserting model {model_name}: {e}")
+                    await cursor.execute(statement)
+                except aiosqlite.OperationalError as e:
+                    # В новых базах колонки уже созданы через CREATE TABLE
+                    if "duplicate column name" not in str(e):
+                        raise
+                # Для DML-миграций (например, заполнение created_at) фиксируем число затронутых строк
+                if cursor.rowcount > 0:
+                    logger.info(f"Migration {version} updated {cursor.rowcount} rows")
+                await cursor.execute("INSERT INTO schema_migrations (version) VALUES (?)", (version,))
+                logger.info(f"Applied migration {version}")
 
+            await cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             await self.connection.commit() # Финальный коммит для init_db
+            logger.info(f"Database schema migrated from version {user_version} to {SCHEMA_VERSION}")
+
+    async def _sync_models(self):
+        # Вставляем AVAILABLE_MODELS только если список изменился с прошлого запуска
+        models_hash = hashlib.sha1(repr(list(AVAILABLE_MODELS)).encode()).hexdigest()
+        async with self.connection.execute("SELECT value FROM meta WHERE key = 'models_hash'") as cursor:
+            row = await cursor.fetchone()
+        if row and row[0] == models_hash:
+            return
+
+        try:
+            await self.connection.executemany(
+                "INSERT OR IGNORE INTO models (name, provider) VALUES (?, ?)",
+                AVAILABLE_MODELS
+            )
+            await self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('models_hash', ?)",
+                (models_hash,)
+            )
+            await self.connection.commit()
+            logger.info(f"Synced {len(AVAILABLE_MODELS)} models into database")
+        except Exception as e:
+            logger.error(f"Error inserting models: {e}")
             
 
     async def close(self):
-        if self.connection:
-            await self.connection.close()
+        await self.pool.close()
+        self.connection = None
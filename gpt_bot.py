@@ -1,25 +1,35 @@
 import os
 import logging
-import uuid
+import itertools
+import time
 import asyncio
-import aiosqlite
+import re
+import hashlib
+import io
+from collections import deque
 from pathlib import Path
 from contextlib import asynccontextmanager
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile, FSInputFile, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton
 import aiohttp
+import msgspec
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
-from tenacity import retry, stop_after_attempt, wait_exponential
+from cachetools import LRUCache, TTLCache
 from g4f.client import AsyncClient
 import g4f.Provider
-from config import DATABASE_PATH, MAX_MESSAGE_LENGTH, DEFAULT_MODEL, DEFAULT_VOICE, ENGLISH_VOICE, VOICES_DIR, VARIATIONS_DIR, IMAGES_DIR
+from config import DATABASE_PATH, MAX_MESSAGE_LENGTH, DEFAULT_MODEL, DEFAULT_VOICE, ENGLISH_VOICE, VOICES_DIR, TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, ensure_dir
 from keyboards import get_main_keyboard, get_cancel_keyboard, get_settings_keyboard, get_text_models_keyboard, get_manage_models_keyboard
 from database import Database
-from instructions import INSTRUCTION_TEXT
+from middlewares import ChatQueueMiddleware, StateData, StateDataMiddleware
+from providers import CircuitOpenError, ProviderBusyError, ProviderGuard
+from instructions import INSTRUCTION_TEXT, GREETING_TEMPLATE
 from g4f.errors import ResponseError
 from datetime import datetime
 import edge_tts
@@ -40,18 +50,58 @@ if not TELEGRAM_BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN is required.")
 
 ADMIN = os.getenv("ADMIN", "")
-# Разбираем строку с ID администраторов вида "123456,789012" в список целых чисел
-ADMIN_IDS = [int(admin_id) for admin_id in ADMIN.split(",") if admin_id.strip().isdigit()] if ADMIN else []
+# Разбираем строку с ID администраторов вида "123456,789012" в множество целых чисел
+ADMIN_IDS = frozenset(int(admin_id) for admin_id in ADMIN.split(",") if admin_id.strip().isdigit())
 
-# Инициализация объекта бота и диспетчера обновлений
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# Инициализация объекта бота и диспетчера обновлений.
+def json_dumps(obj) -> str:
+    """Сериализация JSON через msgspec; aiogram и aiohttp ожидают строку, а не bytes."""
+    return msgspec.json.encode(obj).decode()
+
+# Ответы Bot API (в том числе getUpdates) разбираем и запросы сериализуем через msgspec — он заметно быстрее json
+bot = Bot(token=TELEGRAM_BOT_TOKEN, session=AiohttpSession(json_loads=msgspec.json.decode, json_dumps=json_dumps))
 dp = Dispatcher()
+# Долгие запросы к AI в одном чате не задерживают ответы в других чатах
+dp.update.outer_middleware(ChatQueueMiddleware())
+# Данные FSM читаются один раз на обновление и сохраняются одним вызовом (аргумент state_data)
+dp.message.middleware(StateDataMiddleware())
+dp.callback_query.middleware(StateDataMiddleware())
+
+# Сколько секунд можно ждать следующей порции ответа провайдера или файла
+SOCK_READ_TIMEOUT = 120
+
+# Общая HTTP-сессия для g4f и загрузки файлов: соединения и TLS переиспользуются между запросами
+http_session: aiohttp.ClientSession | None = None
+
+async def on_startup():
+    global http_session, tts_cache_bytes
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60),
+        # Общий таймаут не задаём: генерация изображений и аудио бывает долгой.
+        # Зато ограничиваем установку соединения и паузу между порциями данных: обновления чата
+        # обрабатываются по очереди, и зависший ответ провайдера иначе заблокировал бы весь чат
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=SOCK_READ_TIMEOUT),
+        # Тела JSON-запросов к провайдерам g4f
+        json_serialize=json_dumps
+    )
+    for client in (g4f_client, audio_client, image_client, admin_image_client):
+        client.session = http_session
+    logger.info("HTTP session created")
+    # Очистка кэша речи — оптимизация, её ошибка не должна мешать запуску бота
+    try:
+        tts_cache_bytes = await asyncio.to_thread(prune_tts_cache)
+    except OSError as e:
+        logger.warning(f"Failed to prune TTS cache: {e}")
+
+dp.startup.register(on_startup)
 
 # Обработчики корректного завершения
 async def on_shutdown():
     logger.info("Shutting down...")
     try:
         await bot.session.close()
+        if http_session and not http_session.closed:
+            await http_session.close()
         if hasattr(g4f_client, 'session') and g4f_client.session and hasattr(g4f_client.session, 'close'):
             await g4f_client.close()
         if hasattr(dp, 'storage'):
@@ -62,15 +112,132 @@ async def on_shutdown():
 
 dp.shutdown.register(on_shutdown)
 
+# Лимиты исходящих вызовов Bot API (Telegram допускает ~30 в секунду на бота).
+# Рассылка идёт через отдельный, более медленный лимитер: тысячи её ожидающих отправок
+# не должны стоять в одной очереди с ответами пользователям. Вместе оба лимита укладываются в 30
+telegram_limiter = AsyncLimiter(20, 1)
+broadcast_limiter = AsyncLimiter(10, 1)
+
 # Подключение к базе данных SQLite (инициализация происходит в main())
 db = Database(DATABASE_PATH)
 
 # Клиент g4f для обращения к AI-моделям; ARTA — провайдер для генерации изображений
 g4f_client = AsyncClient(image_provider=g4f.Provider.ARTA)
+# Клиенты с фиксированным провайдером создаются один раз, а не в каждом обработчике
+audio_client = AsyncClient(provider=g4f.Provider.PollinationsAI)   # Аудиоответы
+image_client = AsyncClient(provider=g4f.Provider.ARTA)             # Генерация изображений
+admin_image_client = AsyncClient(provider=g4f.Provider.ImageLabs)  # Генерация изображений (админ)
+# Модель ARTA выбирается один раз при запуске, а не перебором списка моделей на каждый запрос
+ARTA_IMAGE_MODEL = (
+    "yamers_realistic_xl"
+    if "yamers_realistic_xl" in frozenset(m[1] for m in g4f.Provider.ARTA.models)
+    else "realistic_stock_xl"
+)
+
+# У каждого провайдера свой лимит параллельных запросов и свой circuit breaker:
+# медленный или упавший провайдер не занимает обработчики остальных.
+# Через g4f_guard идут все текстовые запросы, поэтому у него больше слотов и длиннее очередь
+g4f_guard = ProviderGuard("g4f", concurrency=16, max_queue=500)
+audio_guard = ProviderGuard("PollinationsAI")
+image_guard = ProviderGuard("ARTA")
+admin_image_guard = ProviderGuard("ImageLabs")
+# Синтез речи edge-tts: запросы не процессорные, но длинные тексты синтезируются долго,
+# поэтому одновременных синтезов немного, остальные ждут в очереди
+tts_guard = ProviderGuard("edge-tts", concurrency=4)
 
 # Клавиатура «Выход» используется во многих режимах — создаём один раз
 cancel_keyboard = get_cancel_keyboard()
 
+# Кэш выбранной модели пользователя: избавляет от JOIN на каждое сообщение.
+# Сбрасывается при смене модели и создании профиля
+user_model_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+
+# Пользователи, чей профиль уже есть в БД: профили не удаляются, поэтому
+# повторная вставка в ensure_profile для них не нужна. Кэш ограничен по размеру и времени,
+# как и остальные кэши по user_id
+known_profiles: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Контекст текущей сессии пользователя: user_id -> (session_id, deque последних 10 пар).
+# Пополняется в save_message_to_history, поэтому в установившемся диалоге история не читается из БД
+history_cache: TTLCache = TTLCache(maxsize=10_000, ttl=1800)
+
+# Последний текстовый запрос пользователя: user_id -> (время отправки, хэш текста).
+# Нужен, чтобы не отправлять в AI одинаковый запрос при случайном двойном нажатии
+last_requests: TTLCache = TTLCache(maxsize=10_000, ttl=10)
+DUPLICATE_REQUEST_WINDOW = 1  # секунд между одинаковыми сообщениями
+
+# Недавние ответы: (user_id, модель, вопрос) -> ответ. Если пользователь повторно отправил
+# тот же вопрос в течение минуты, отдаём уже полученный ответ, а не запрашиваем AI заново
+reply_cache: TTLCache = TTLCache(maxsize=1_000, ttl=60)
+
+# Список активных моделей для меню настроек: таблица models меняется только администратором,
+# поэтому читаем её один раз и сбрасываем кэш при переключении статуса модели
+active_models_cache: list | None = None
+# Клавиатура управления моделями для администратора; сбрасывается там же, где и список активных моделей
+manage_models_keyboard_cache = None
+
+# Запрещённые слова в промптах для генерации изображений — один регэксп вместо цикла по списку
+FORBIDDEN_KEYWORDS = ("обнажённая", "nude", "naked", "adult")
+FORBIDDEN_RE = re.compile("|".join(map(re.escape, FORBIDDEN_KEYWORDS)), re.IGNORECASE)
+
+# Ответы на недопустимые промпты для генерации изображений; пример допустимых запросов общий
+IMAGE_PROMPT_EXAMPLES = (
+    "Примеры допустимых запросов:\n"
+    "• 'Красивый закат на пляже'\n"
+    "• 'Кот в шляфе, цифровая живопись'\n"
+    "• 'Футуристический город ночью'"
+)
+FORBIDDEN_PROMPT_TEXT = (
+    "⚠️ Запрос содержит недопустимый контент.\n\n"
+    "Пожалуйста, измените ваш запрос, чтобы он соответствовал правилам.\n\n"
+    + IMAGE_PROMPT_EXAMPLES
+)
+IMAGE_PROMPT_REJECTED_TEXT = (
+    "⚠️ Извините, мне запрещено генерировать изображения по такому запросу.\n\n"
+    "Пожалуйста, измените ваш запрос, чтобы он не содержал запрещённых тем или формулировок.\n\n"
+    + IMAGE_PROMPT_EXAMPLES
+)
+IMAGE_RESPONSE_ERROR_TEXT = (
+    "⚠️ Ошибка обработки ответа от провайдера. Возможно, запрос содержит недопустимый контент.\n\n"
+    "Пожалуйста, измените ваш запрос, чтобы он соответствовал правилам.\n\n"
+    + IMAGE_PROMPT_EXAMPLES
+)
+
+# Размер страницы получателей рассылки
+BROADCAST_PAGE_SIZE = 1000
+
+# Ответ на видео и документы; чаты, которым он уже отправлен, помнятся минуту
+UNSUPPORTED_MEDIA_TEXT = (
+    "⚠️ Извините, я пока не умею работать с видео или файлами. "
+    "Пожалуйста, отправьте текстовое сообщение или изображение."
+)
+unsupported_media_warned: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+# Бюджет контекста из истории в символах (~3000 токенов при ~4 символах на токен)
+CONTEXT_CHAR_BUDGET = 12_000
+
+# Место под заголовок "(i/N)\n\n" в каждой части длинного ответа
+PART_HEADER_RESERVE = 16
+
+VOICE_BUTTON_TEXT = "🔊 Перевести в голос"
+
+# Тексты частей ответов для кнопки «Перевести в голос»: (chat_id, message_id, part_index) -> текст.
+# Хранятся в памяти процесса, а не в FSM, чтобы не сериализовать их при каждом обновлении состояния
+voice_text_cache: LRUCache = LRUCache(maxsize=1_000)
+
+# Наличие хотя бы одной кириллической буквы — признак русского текста для выбора голоса
+CYRILLIC_RE = re.compile("[а-яё]", re.IGNORECASE)
+
+# Уникальные имена временных файлов: pid + время запуска + счётчик вместо uuid4 (без чтения /dev/urandom)
+_temp_name_prefix = f"{os.getpid():x}{int(time.time()):x}"
+_temp_name_counter = itertools.count()
+
+def unique_name() -> str:
+    return f"{_temp_name_prefix}{next(_temp_name_counter):x}"
+
+# Любой символ, кроме букв и цифр, в имени временного файла заменяется на "_"
+UNSAFE_FILENAME_CHAR_RE = re.compile(r"\W")
+
 # ---------------------------------------------------------------------------
 # FSM (Finite State Machine) — машина состояний.
 # Каждое состояние означает, что бот ждёт определённого ввода от пользователя.
@@ -90,165 +257,362 @@ class UserStates(StatesGroup):
 # Вспомогательные функции
 # ---------------------------------------------------------------------------
 async def ensure_profile(user: types.User):
-    """Создаёт профиль пользователя при первом обращении, если его ещё нет."""
-    cursor = await db.connection.execute("SELECT 1 FROM profiles WHERE user_id = ?", (user.id,))
-    if not await cursor.fetchone():
-        await db.connection.execute(
-            "INSERT INTO profiles (user_id, name, created_at) VALUES (?, ?, datetime('now', 'localtime'))",
+    """Создаёт профиль пользователя при первом обращении, если его ещё нет.
+    Для нового профиля возвращает строку в том же виде, что и show_profile
+    (name, gpt_requests, image_requests, audio_requests, created_at); для существующего — None.
+    """
+    if user.id in known_profiles:
+        return None
+    async with db.writer() as conn:
+        # Одна вставка вместо SELECT + INSERT: RETURNING вернёт строку только для нового профиля
+        rows = await conn.execute_fetchall(
+            "INSERT INTO profiles (user_id, name, created_at) VALUES (?, ?, datetime('now', 'localtime')) "
+            "ON CONFLICT(user_id) DO NOTHING "
+            "RETURNING name, gpt_requests, image_requests, audio_requests, substr(created_at, 1, 19)",
             (user.id, user.full_name)
         )
-        # Устанавливаем модель по умолчанию для нового пользователя
-        await db.connection.execute(
-            "INSERT OR IGNORE INTO user_settings (user_id, model_id) VALUES (?, (SELECT id FROM models WHERE name = ? LIMIT 1))",
-            (user.id, DEFAULT_MODEL)
+        created = rows[0] if rows else None
+        if created:
+            # Устанавливаем модель по умолчанию для нового пользователя
+            await conn.execute(
+                "INSERT OR IGNORE INTO user_settings (user_id, model_id) VALUES (?, (SELECT id FROM models WHERE name = ? LIMIT 1))",
+                (user.id, DEFAULT_MODEL)
+            )
+        await conn.commit()
+    known_profiles[user.id] = True
+    if created:
+        user_model_cache.pop(user.id, None)
+    return created
+
+async def get_current_session(user: types.User) -> int:
+    """Выделяет новый ID сессии из счётчика profiles.next_session_id.
+    Используется для группировки сообщений по диалогам при нажатии «Новый чат».
+    Вместо поиска MAX(session_id) по истории — одно обновление строки профиля.
+    """
+    async with db.writer() as conn:
+        rows = await conn.execute_fetchall(
+            "UPDATE profiles SET next_session_id = next_session_id + 1 WHERE user_id = ? RETURNING next_session_id - 1",
+            (user.id,)
         )
-        await db.connection.commit()
+        row = rows[0] if rows else None
+        await conn.commit()
+    if row:
+        return row[0]
+    # Профиля ещё нет — создаём его с настоящим именем пользователя, счётчик начинается с 1.
+    # Отметку в known_profiles снимаем, иначе ensure_profile пропустит вставку и рекурсия не закончится
+    known_profiles.pop(user.id, None)
+    await ensure_profile(user)
+    return await get_current_session(user)
 
-async def get_current_session(user_id: int) -> int:
-    """Возвращает ID текущей сессии (максимальный из БД).
-    Используется для группировки сообщений по диалогам при нажатии «Новый чат».
+async def get_session_id(user: types.User, state_data: StateData) -> int:
+    """Возвращает ID текущей сессии из данных FSM. Новая сессия выделяется только если её там нет,
+    и сразу записывается в состояние, чтобы следующие запросы не обращались к БД.
     """
-    cursor = await db.connection.execute(
-        "SELECT COALESCE(MAX(session_id), 0) + 1 FROM history WHERE user_id = ?",
-        (user_id,)
-    )
-    row = await cursor.fetchone()
-    return row[0]
+    session_id = state_data.get("session_id")
+    if not session_id:
+        session_id = await get_current_session(user)
+        state_data.set("session_id", session_id)
+    return session_id
+
+async def get_active_models() -> list:
+    """Возвращает список (id, name) активных моделей, читая БД только при пустом кэше."""
+    global active_models_cache
+    if active_models_cache is None:
+        async with db.reader() as conn:
+            active_models_cache = await conn.execute_fetchall("SELECT id, name FROM models WHERE is_active = 1 ORDER BY name")
+    return active_models_cache
+
+async def get_manage_models_markup():
+    """Возвращает клавиатуру управления моделями или None, если моделей в БД нет.
+    Клавиатура строится один раз и хранится до переключения статуса модели.
+    """
+    global manage_models_keyboard_cache
+    if manage_models_keyboard_cache is None:
+        async with db.reader() as conn:
+            models = await conn.execute_fetchall("SELECT id, name, provider, is_active FROM models ORDER BY name")
+        if not models:
+            return None
+        manage_models_keyboard_cache = get_manage_models_keyboard(models)
+    return manage_models_keyboard_cache
 
-async def get_user_model(user_id: int) -> str:
+async def get_user_model(user: types.User) -> str:
     """Возвращает название AI-модели, выбранной пользователем в настройках.
     Если настройка не найдена — возвращает модель по умолчанию (DEFAULT_MODEL).
     """
-    cursor = await db.connection.execute("""
-        SELECT m.name FROM user_settings us
-        JOIN models m ON us.model_id = m.id
-        WHERE us.user_id = ?
-    """, (user_id,))
-    row = await cursor.fetchone()
+    user_id = user.id
+    cached = user_model_cache.get(user_id)
+    if cached is not None:
+        return cached
+    async with db.reader() as conn:
+        rows = await conn.execute_fetchall("""
+            SELECT m.name FROM user_settings us
+            JOIN models m ON us.model_id = m.id
+            WHERE us.user_id = ?
+        """, (user_id,))
+        row = rows[0] if rows else None
     if not row:
-        await ensure_profile(types.User(id=user_id, first_name="User", is_bot=False))
+        await ensure_profile(user)
         return DEFAULT_MODEL
+    user_model_cache[user_id] = row[0]
     return row[0]
 
-async def fetch_user_history(user_id: int, session_id: int) -> list:
-    """Возвращает до 20 последних пар (вопрос, ответ) для текущей сессии.
+async def fetch_user_history(user_id: int, session_id: int, limit: int = 10) -> list:
+    """Возвращает до limit (не больше 10) последних пар (вопрос, ответ) текущей сессии в хронологическом порядке.
     Используется для передачи контекста диалога в AI-модель.
+    Порядок по id совпадает с порядком вставки, поэтому отдельная сортировка по timestamp не нужна.
+    Результат кэшируется в history_cache до смены сессии.
     """
-    cursor = await db.connection.execute("""
-        SELECT message, reply FROM history
-        WHERE user_id = ? AND session_id = ?
-        ORDER BY timestamp ASC
-        LIMIT 20
-    """, (user_id, session_id))
-    return await cursor.fetchall()
-
-async def save_message_to_history(user_id: int, text: str, reply: str, session_id: int):
-    """Сохраняет пару вопрос/ответ в историю и увеличивает счётчик GPT-запросов."""
-    await db.connection.execute(
-        "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)",
-        (user_id, text, reply, session_id)
-    )
-    await db.connection.execute(
-        "UPDATE profiles SET gpt_requests = gpt_requests + 1 WHERE user_id = ?",
-        (user_id,)
+    cached = history_cache.get(user_id)
+    if cached is not None and cached[0] == session_id:
+        return list(cached[1])[-limit:]
+    async with db.reader() as conn:
+        rows = await conn.execute_fetchall("""
+            SELECT message, reply FROM history
+            WHERE user_id = ? AND session_id = ?
+            ORDER BY id DESC
+            LIMIT 10
+        """, (user_id, session_id))
+    rows.reverse()
+    # В кэш кладём все 10 строк, чтобы его могли использовать и вызовы с большим limit
+    history_cache[user_id] = (session_id, deque(rows, maxlen=10))
+    return rows[-limit:]
+
+async def load_session_context(user: types.User, state_data: StateData) -> tuple:
+    """Возвращает (session_id, история сессии) — всё, что нужно для построения контекста запроса."""
+    session_id = await get_session_id(user, state_data)
+    return session_id, await fetch_user_history(user.id, session_id)
+
+def normalize_prompt(text: str) -> str:
+    """Приводит вопрос к виду для ключа кэша: без учёта регистра и лишних пробелов."""
+    return " ".join(text.casefold().split())
+
+def is_duplicate_request(message: types.Message, text: str) -> bool:
+    """Проверяет, не повторяет ли сообщение предыдущий запрос пользователя, отправленный только что.
+    Сравнивается время отправки из Telegram, а не время обработки: сообщения одного чата
+    обрабатываются по очереди, и второе может начать обрабатываться намного позже первого.
+    """
+    user_id = message.from_user.id
+    key = (message.date, hash(text))
+    previous = last_requests.get(user_id)
+    last_requests[user_id] = key
+    return (
+        previous is not None
+        and previous[1] == key[1]
+        and (message.date - previous[0]).total_seconds() <= DUPLICATE_REQUEST_WINDOW
     )
-    await db.connection.commit()
+
+def trim_history(prev_msgs: list, budget: int = CONTEXT_CHAR_BUDGET) -> list:
+    """Оставляет самые свежие пары из истории, суммарная длина которых укладывается в budget символов.
+    Одно длинное сообщение вытесняет старые пары, а много коротких помещаются целиком.
+    """
+    total = 0
+    start = len(prev_msgs)
+    for hist_msg, hist_reply in reversed(prev_msgs):
+        total += len(hist_msg) + len(hist_reply)
+        if total > budget:
+            break
+        start -= 1
+    return prev_msgs[start:]
+
+def build_chat_messages(prev_msgs: list, text: str) -> list:
+    """Собирает список сообщений для AI: пары из истории (в пределах бюджета контекста) и текущий вопрос."""
+    messages = [
+        {"role": role, "content": content}
+        for hist_msg, hist_reply in trim_history(prev_msgs)
+        for role, content in (("user", hist_msg), ("assistant", hist_reply))
+    ]
+    messages.append({"role": "user", "content": text})
+    return messages
+
+# SQL горячего пути записи вынесен в константы: sqlite3 кэширует скомпилированные
+# выражения по тексту запроса, и один и тот же текст гарантирует повторное использование
+INSERT_HISTORY_SQL = "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)"
+
+# Счётчики профиля, которые увеличиваются вместе с записью в историю.
+# Тем же UPDATE обновляется время последней активности; ключ None — запись без счётчика
+COUNTER_UPDATES = {
+    "gpt": "UPDATE profiles SET gpt_requests = gpt_requests + 1, last_activity = datetime('now', 'localtime') WHERE user_id = ?",
+    "image": "UPDATE profiles SET image_requests = image_requests + 1, last_activity = datetime('now', 'localtime') WHERE user_id = ?",
+    "audio": "UPDATE profiles SET audio_requests = audio_requests + 1, last_activity = datetime('now', 'localtime') WHERE user_id = ?",
+    None: "UPDATE profiles SET last_activity = datetime('now', 'localtime') WHERE user_id = ?",
+}
+
+UPSERT_USER_STATS_SQL = (
+    "INSERT INTO user_stats (user_id, date, action_type, model_name, count) VALUES (?, ?, ?, ?, 1) "
+    "ON CONFLICT(user_id, date, action_type, model_name) DO UPDATE SET count = count + 1"
+)
+
+# Сводная статистика для админки обновляется вместе с user_stats
+UPSERT_USER_STATS_DAILY_SQL = (
+    "INSERT INTO user_stats_daily (date, action_type, model_name, total_count) VALUES (?, ?, ?, 1) "
+    "ON CONFLICT(date, action_type, model_name) DO UPDATE SET total_count = total_count + 1"
+)
+
+async def save_message_to_history(user_id: int, text: str, reply: str, session_id: int, counter: str | None = "gpt",
+                                  stats_model: str | None = None):
+    """Сохраняет пару вопрос/ответ в историю, увеличивает счётчик запросов (gpt/image/audio)
+    и обновляет время последней активности пользователя.
+    Если передан stats_model, в той же транзакции обновляется дневная статистика текстовых запросов.
+    Все записи выполняются в одной транзакции с одним коммитом.
+    """
+    async with db.writer() as conn:
+        await conn.execute(INSERT_HISTORY_SQL, (user_id, text, reply, session_id))
+        await conn.execute(COUNTER_UPDATES[counter], (user_id,))
+        if stats_model:
+            today = str(datetime.now().date())
+            await conn.execute(UPSERT_USER_STATS_SQL, (user_id, today, "text", stats_model))
+            await conn.execute(UPSERT_USER_STATS_DAILY_SQL, (today, "text", stats_model))
+        await conn.commit()
+    cached = history_cache.get(user_id)
+    if cached is not None and cached[0] == session_id:
+        cached[1].append((text, reply))
 
 @asynccontextmanager
 async def temp_audio_file(user_id: int, text: str):
     """Контекстный менеджер для временного аудиофайла.
     Автоматически удаляет файл после отправки пользователю.
     """
-    media_dir = Path(VOICES_DIR)
-    unique_id = uuid.uuid4().hex
+    media_dir = Path(ensure_dir(VOICES_DIR))
+    unique_id = unique_name()
     # Оставляем только буквы/цифры в названии файла, чтобы избежать проблем с ОС
-    safe_text = "".join(c if c.isalnum() else "_" for c in text)[:50]
+    safe_text = UNSAFE_FILENAME_CHAR_RE.sub("_", text[:50])
     audio_filename = f"audio_{user_id}_{safe_text}_{unique_id}.mp3"
     audio_path = media_dir / audio_filename
     try:
         yield audio_path
     finally:
         try:
-            if audio_path.exists():
-                audio_path.unlink()
+            # Удаление файла выполняем в потоке, чтобы не блокировать event loop
+            await asyncio.to_thread(audio_path.unlink, missing_ok=True)
         except Exception as e:
             logger.error(f"Failed to delete temporary audio file {audio_path}: {e}")
 
-@asynccontextmanager
-async def temp_image_file(user_id: int, suffix: str):
-    """Контекстный менеджер для временного файла вариации изображения.
-    Возвращает путь к файлу; файл нужно сохранить внутри блока 'async with'.
-    Примечание: файл не удаляется автоматически — его нужно удалить вручную
-    после отправки пользователю (см. handle_image_variations).
+async def download_photo(url: str):
+    """Скачивает сгенерированное изображение через общую HTTP-сессию и возвращает его для загрузки в Telegram.
+    Серверы Telegram часто не успевают скачать картинку у провайдера сами;
+    если скачать не удалось, возвращается исходный URL.
     """
-    media_dir = Path(VARIATIONS_DIR)
-    media_dir.mkdir(parents=True, exist_ok=True)
-    unique_id = uuid.uuid4().hex
-    image_filename = f"variation_{user_id}_{unique_id}_{suffix}.png"
-    image_path = media_dir / image_filename
     try:
-        logger.debug(f"Creating temporary image file: {image_path}")
-        yield image_path
-    except Exception as e:
-        logger.error(f"Error in temp_image_file for {image_path}: {e}")
-        raise
+        async with http_session.get(url) as resp:
+            resp.raise_for_status()
+            image_data = await resp.read()
+        return BufferedInputFile(image_data, filename="image.png")
+    except aiohttp.ClientError as e:
+        logger.warning(f"Failed to download generated image, sending URL instead: {e}")
+        return url
 
-async def generate_voice(text: str, language: str = "ru") -> str:
+async def generate_voice(text: str, language: str = "ru") -> Path:
     """Синтезирует речь из текста через Microsoft edge-tts и сохраняет MP3-файл.
     Язык определяется автоматически по наличию кириллических символов.
+    Результат для пары (голос, текст) детерминирован, поэтому файл кэшируется в TTS_CACHE_DIR
+    и при повторном запросе возвращается без обращения к edge-tts.
     """
     voice = DEFAULT_VOICE if language == "ru" else ENGLISH_VOICE
-    unique_id = uuid.uuid4().hex
-    audio_path = Path(VOICES_DIR) / f"voice_{unique_id}.mp3"
-    
+    cache_dir = Path(ensure_dir(TTS_CACHE_DIR))
+    key = hashlib.sha256(f"{voice}|{text}".encode()).hexdigest()
+    audio_path = cache_dir / f"{key}.mp3"
+    if audio_path.exists():
+        # Обновляем время изменения: по нему prune_tts_cache удаляет давно не использованные файлы
+        await asyncio.to_thread(os.utime, audio_path)
+        return audio_path
+
+    # Пишем во временный файл и переименовываем: параллельный запрос того же текста не увидит неполный MP3
+    part_path = cache_dir / f"{key}.{unique_name()}.part"
     try:
         communicate = edge_tts.Communicate(text, voice)
-        await communicate.save(str(audio_path))
+        await tts_guard.call(communicate.save, str(part_path))
+        size = (await asyncio.to_thread(part_path.stat)).st_size
+        await asyncio.to_thread(os.replace, part_path, audio_path)
+        await track_tts_cache_write(size)
         return audio_path
     except Exception as e:
         logger.error(f"Error generating voice: {e}")
+        await asyncio.to_thread(part_path.unlink, missing_ok=True)
         raise
 
-async def create_image_variations(image_path: Path, user_id: int, num_variations: int = 4) -> list:
+# Примерный размер кэша речи: пересчитывается при очистке и увеличивается после каждой записи
+tts_cache_bytes = 0
+
+async def track_tts_cache_write(size: int):
+    """Учитывает новый файл в размере кэша речи и очищает кэш, когда размер превышает лимит."""
+    global tts_cache_bytes
+    tts_cache_bytes += size
+    if tts_cache_bytes > TTS_CACHE_MAX_BYTES:
+        # Сбрасываем оценку до очистки, чтобы параллельные записи не запускали её повторно
+        tts_cache_bytes = 0
+        try:
+            tts_cache_bytes += await asyncio.to_thread(prune_tts_cache)
+        except OSError as e:
+            logger.warning(f"Failed to prune TTS cache: {e}")
+            return
+        logger.info(f"TTS cache pruned to {tts_cache_bytes} bytes")
+
+def prune_tts_cache(max_bytes: int = TTS_CACHE_MAX_BYTES) -> int:
+    """Удаляет самые старые файлы кэша речи, пока суммарный размер превышает max_bytes.
+    Возвращает размер кэша после очистки.
+    """
+    files = []
+    for entry in Path(ensure_dir(TTS_CACHE_DIR)).iterdir():
+        # Временные файлы ещё записываются параллельными запросами
+        if entry.suffix == ".part":
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry))
+    total = sum(size for _, size, _ in files)
+    for _, size, entry in sorted(files, key=lambda item: item[0]):
+        if total <= max_bytes:
+            break
+        entry.unlink(missing_ok=True)
+        total -= size
+    return total
+
+# Яркость +50% через таблицу подстановки: один проход point() вместо смешивания с чёрным изображением
+BRIGHTNESS_LUT = [min(255, round(v * 1.5)) for v in range(256)] * 3
+
+# Фильтры для вариаций изображения: (суффикс файла, преобразование). Каждое преобразование
+# только читает исходное изображение, поэтому их можно выполнять параллельно в разных потоках
+VARIATION_FILTERS = (
+    ("bright", lambda image: image.point(BRIGHTNESS_LUT)),
+    ("contrast", lambda image: ImageEnhance.Contrast(image).enhance(1.5)),
+    ("blur", lambda image: image.filter(ImageFilter.GaussianBlur(radius=2))),
+    # Сохраняем в режиме "L": обратное преобразование в RGB не нужно, PNG втрое меньше
+    ("bw", lambda image: image.convert("L")),
+)
+
+def render_variation(image: Image.Image, transform) -> bytes:
+    """Применяет фильтр и кодирует результат в PNG в памяти. Выполняется в отдельном потоке.
+    compress_level=1 кодирует PNG в несколько раз быстрее уровня по умолчанию (6);
+    файлы получаются крупнее, но остаются далеко от лимита Telegram в 10 МБ.
+    """
+    buffer = io.BytesIO()
+    transform(image).save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+async def create_image_variations(image_source, user_id: int, num_variations: int = 4) -> list:
     """Создаёт 4 варианта изображения с разными фильтрами:
     1. Яркость +50%
     2. Контрастность +50%
     3. Размытие (Gaussian Blur)
     4. Чёрно-белое
-    Возвращает список путей к сохранённым PNG-файлам.
+    image_source — путь к файлу, файловый объект с байтами изображения или уже открытое изображение PIL.
+    Обработка и сохранение выполняются в пуле потоков параллельно, не блокируя event loop.
+    Возвращает список PNG-изображений в виде байтов, готовых к отправке без записи на диск.
     """
     try:
         logger.info(f"Opening image for user_id={user_id}")
-        image = Image.open(image_path).convert("RGB")
-        variations = []
-        
-        logger.info(f"Generating brightness variation for user_id={user_id}")
-        async with temp_image_file(user_id, "bright") as bright_path:
-            enhancer = ImageEnhance.Brightness(image)
-            bright_image = enhancer.enhance(1.5)
-            bright_image.save(bright_path, "PNG")
-            variations.append(bright_path)
-        
-        logger.info(f"Generating contrast variation for user_id={user_id}")
-        async with temp_image_file(user_id, "contrast") as contrast_path:
-            enhancer = ImageEnhance.Contrast(image)
-            contrast_image = enhancer.enhance(1.5)
-            contrast_image.save(contrast_path, "PNG")
-            variations.append(contrast_path)
-        
-        logger.info(f"Generating blur variation for user_id={user_id}")
-        async with temp_image_file(user_id, "blur") as blur_path:
-            blur_image = image.filter(ImageFilter.GaussianBlur(radius=2))
-            blur_image.save(blur_path, "PNG")
-            variations.append(blur_path)
-        
-        logger.info(f"Generating black-and-white variation for user_id={user_id}")
-        async with temp_image_file(user_id, "bw") as bw_path:
-            bw_image = image.convert("L").convert("RGB")
-            bw_image.save(bw_path, "PNG")
-            variations.append(bw_path)
-        
-        return variations
+        if isinstance(image_source, Image.Image):
+            image = image_source.convert("RGB")
+        else:
+            image = await asyncio.to_thread(lambda: Image.open(image_source).convert("RGB"))
+        jobs = [
+            asyncio.to_thread(render_variation, image, transform)
+            for _, transform in VARIATION_FILTERS[:num_variations]
+        ]
+        logger.info(f"Generating {len(jobs)} variations for user_id={user_id}")
+        return await asyncio.gather(*jobs)
     except UnidentifiedImageError:
         logger.error(f"Invalid image file for user_id={user_id}")
         raise ValueError("Невозможно открыть изображение. Убедитесь, что файл является действительным изображением.")
@@ -261,38 +625,13 @@ async def create_image_variations(image_path: Path, user_id: int, num_variations
 # Каждая функция регистрируется в диспетчере через декораторы @dp.message / @dp.callback_query
 # ---------------------------------------------------------------------------
 @dp.message(Command("start"))
-async def start(message: types.Message, state: FSMContext):
+async def start(message: types.Message, state_data: StateData):
     user = message.from_user
     await ensure_profile(user)
-    await state.update_data(session_id=await get_current_session(user.id))
+    state_data.set("session_id", await get_current_session(user))
     is_admin = user.id in ADMIN_IDS
     await message.answer(
-        f"""Привет, <b>{user.first_name}</b>! 👋\n\n
-        Я — умный бот на основе GPT-4, готовый помочь с различными задачами.  
-
-<b>Что я умею?</b>  
-✨ Отвечать на вопросы по разным темам
-🎙 Генерировать голосовые ответы
-🔊 Переводить текстовые ответы в голос
-💻 Помогать с программированием и кодом
-🎨 Генерировать изображения по описанию
-🖌 Создавать вариации изображений
-🖼 Обрабатывать изображения
-🎭 Поддерживать интерактивные сценарии 
-
-<b>Как мной пользоваться?</b>  
-Просто напиши мне сообщение — я постараюсь помочь!  
-Для генерации изображения нажми кнопку <b>🎨 Генерация изображения</b>.
-Для создания вариаций изображения нажми <b>🖌 Вариации изображения</b>.
-Для генерации аудиоответа нажми кнопку <b>"🎙 Ответ голосом"</b>.  
-Для перевода текста в голос нажми <b>"🔊 Перевести в голос"</b>.
-Для поиска в интернете нажми кнопку <b>"🌐 Поиск в интернете"</b>.
-Для настройки параметров нажми кнопку <b>"⚙️ Настройки"</b>.
-Для выхода из чата нажми кнопку <b>"👉 Выход"</b>.
-Для просмотра истории сообщений нажми кнопку <b>"🕓 История"</b>.
-Для просмотра своего профиля нажми кнопку <b>"👤 Профиль"</b>. 
-
-Начнём? 😊""",
+        GREETING_TEMPLATE.format(name=user.first_name),
         reply_markup=get_main_keyboard(user.id, is_admin),
         parse_mode="HTML"
     )
@@ -320,7 +659,7 @@ async def handle_exit(message: types.Message, state: FSMContext):
 @dp.message(F.text == "⚙️ Настройки")
 async def show_settings(message: types.Message, state: FSMContext):
     await state.clear()
-    current_model = await get_user_model(message.from_user.id)
+    current_model = await get_user_model(message.from_user)
     await message.answer(
         f"⚙️ <b>Настройки</b>\n\nТекущая модель: <b>{current_model}</b>",
         parse_mode="HTML",
@@ -330,10 +669,8 @@ async def show_settings(message: types.Message, state: FSMContext):
 @dp.callback_query(F.data == "text_models")
 async def show_text_models(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    cursor = await db.connection.execute("SELECT id, name FROM models WHERE is_active = 1 ORDER BY name")
-    models = await cursor.fetchall()
-    
-    current_model = await get_user_model(user_id)
+    models = await get_active_models()
+    current_model = await get_user_model(callback.from_user)
     await callback.message.edit_text(
         "Выберите модель для текстовых ответов:",
         parse_mode="HTML",
@@ -343,7 +680,7 @@ async def show_text_models(callback: types.CallbackQuery):
 
 async def show_settings_from_query(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    current_model = await get_user_model(user_id)
+    current_model = await get_user_model(callback.from_user)
     await callback.message.edit_text(
         f"⚙️ <b>Настройки</b>\n\nТекущая модель: <b>{current_model}</b>",
         parse_mode="HTML",
@@ -352,52 +689,63 @@ async def show_settings_from_query(callback: types.CallbackQuery):
     await callback.answer()
 
 @dp.message(F.text == "🕓 История")
-async def show_history(message: types.Message, state: FSMContext):
+async def show_history(message: types.Message, state_data: StateData):
     user_id = message.from_user.id
-    await state.update_data(history_message_ids=[])
-    data = await state.get_data()
+    is_admin = user_id in ADMIN_IDS
+    # ID отправленных сообщений копим локально и сохраняем в FSM один раз после обработчика
+    history_message_ids = []
     
     try:
-        cursor = await db.connection.execute("""
-            SELECT message, reply, timestamp
-            FROM history
-            WHERE user_id = ?
-            ORDER BY timestamp DESC
-            LIMIT 5
-        """, (user_id,))
-        rows = await cursor.fetchall()
+        async with db.reader() as conn:
+            rows = await conn.execute_fetchall("""
+                SELECT message, reply, timestamp
+                FROM history
+                WHERE user_id = ?
+                ORDER BY timestamp DESC
+                LIMIT 5
+            """, (user_id,))
 
         if not rows:
             msg = await message.answer(
                 "История сообщений пуста.",
-                reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS))
-            data['history_message_ids'].append(msg.message_id)
-            await state.set_data(data)
+                reply_markup=get_main_keyboard(user_id, is_admin=is_admin))
+            history_message_ids.append(msg.message_id)
             return
 
+        # Записи объединяем в как можно меньшее число сообщений (обычно одно),
+        # не разрывая запись между сообщениями, чтобы не ломать HTML-разметку
+        chunks = []
+        current = ""
         for i, (msg_text, reply_text, ts) in enumerate(rows[::-1], 1):
-            message_text = (
+            entry = (
                 f"<b>Сообщение #{i} ({ts[:19]})</b>\n"
                 f"👤 <b>Вы:</b> {msg_text[:500]}{'...' if len(msg_text) > 500 else ''}\n"
                 f"🤖 <b>Бот:</b> {reply_text[:500]}{'...' if len(reply_text) > 500 else ''}"
             )
-            msg = await message.answer(message_text, parse_mode="HTML")
-            data['history_message_ids'].append(msg.message_id)
-            await state.set_data(data)
+            if current and len(current) + 2 + len(entry) > MAX_MESSAGE_LENGTH:
+                chunks.append(current)
+                current = entry
+            else:
+                current = f"{current}\n\n{entry}" if current else entry
+        chunks.append(current)
+
+        for chunk in chunks:
+            msg = await message.answer(chunk, parse_mode="HTML")
+            history_message_ids.append(msg.message_id)
 
         builder = InlineKeyboardBuilder()
         builder.add(InlineKeyboardButton(text="🗑 Очистить историю", callback_data="confirm_clear"))
         msg = await message.answer("Вы можете очистить историю:", reply_markup=builder.as_markup())
-        data['history_message_ids'].append(msg.message_id)
-        await state.set_data(data)
+        history_message_ids.append(msg.message_id)
         
     except Exception as e:
         logger.error(f"Error in history handler for user_id={user_id}: {e}", exc_info=True)
         msg = await message.answer(
             "Произошла ошибка при получении истории.",
-            reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS))
-        data['history_message_ids'].append(msg.message_id)
-        await state.set_data(data)
+            reply_markup=get_main_keyboard(user_id, is_admin=is_admin))
+        history_message_ids.append(msg.message_id)
+    finally:
+        state_data.set("history_message_ids", history_message_ids)
 
 @dp.callback_query(F.data == "confirm_clear")
 async def clear_history_callback(callback: types.CallbackQuery, state: FSMContext):
@@ -411,22 +759,28 @@ async def clear_history_callback(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 @dp.callback_query(F.data == "do_clear")
-async def do_clear_history(callback: types.CallbackQuery, state: FSMContext):
+async def do_clear_history(callback: types.CallbackQuery, state_data: StateData):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
-    data = await state.get_data()
     
-    await db.connection.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
-    await db.connection.commit()
+    async with db.writer() as conn:
+        await conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+        await conn.commit()
+    history_cache.pop(user_id, None)
     
-    if 'history_message_ids' in data:
-        for msg_id in reversed(data['history_message_ids']):
-            try:
-                await bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                await asyncio.sleep(0.3)
-            except Exception as e:
-                if "not found" not in str(e).lower():
-                    logger.error(f"Failed to delete message {msg_id} for user_id={user_id}: {e}")
+    async def delete_history_message(msg_id: int):
+        async with telegram_limiter:
+            await bot.delete_message(chat_id=chat_id, message_id=msg_id)
+
+    # Удаляем сообщения параллельно; частоту запросов ограничивает telegram_limiter
+    message_ids = state_data.get('history_message_ids', [])
+    results = await asyncio.gather(
+        *(delete_history_message(msg_id) for msg_id in message_ids),
+        return_exceptions=True
+    )
+    for msg_id, result in zip(message_ids, results):
+        if isinstance(result, Exception) and "not found" not in str(result).lower():
+            logger.error(f"Failed to delete message {msg_id} for user_id={user_id}: {result}")
     
     try:
         await callback.message.delete()
@@ -440,7 +794,7 @@ async def do_clear_history(callback: types.CallbackQuery, state: FSMContext):
         text="🗑 История очищена!",
         reply_markup=get_main_keyboard(user_id, is_admin=is_admin))
     
-    await state.update_data(history_message_ids=[])
+    state_data.set("history_message_ids", [])
     await callback.answer()
 
 @dp.callback_query(F.data == "cancel_clear")
@@ -470,10 +824,8 @@ async def start_audio_response(message: types.Message, state: FSMContext):
         reply_markup=cancel_keyboard
     )
 
-async def exit_audio_mode(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    session_id = data.get("session_id", await get_current_session(message.from_user.id))
-    await state.update_data(session_id=session_id)
+async def exit_audio_mode(message: types.Message, state: FSMContext, state_data: StateData):
+    await get_session_id(message.from_user, state_data)
     await state.set_state(None)
     await message.answer(
         "Вы вышли из режима генерации аудиоответов.",
@@ -490,7 +842,7 @@ async def start_text_to_voice(message: types.Message, state: FSMContext):
     )
 
 @dp.message(UserStates.awaiting_text_to_voice, F.text)
-async def handle_text_to_voice(message: types.Message, state: FSMContext):
+async def handle_text_to_voice(message: types.Message, state: FSMContext, state_data: StateData):
     user_id = message.from_user.id
     text = message.text.strip()
     
@@ -513,45 +865,31 @@ async def handle_text_to_voice(message: types.Message, state: FSMContext):
 
     try:
         # Определяем язык на основе текста
-        language = "ru" if any(c in text.lower() for c in "абвгдеёжзийклмнопрстуфхцчшщъыьэюя") else "en"
+        language = "ru" if CYRILLIC_RE.search(text) else "en"
         
         # Генерируем голосовой файл
-        async with temp_audio_file(user_id, text) as audio_path:
-            audio_path = await generate_voice(text, language)
-            if not audio_path:
-                logger.error(f"Failed to generate voice for user_id={user_id}: No audio path returned")
-                await msg.delete()
-                await message.answer(
-                    "Не удалось сгенерировать голосовой ответ. Попробуйте другой текст.",
-                    reply_markup=cancel_keyboard
-                )
-                return
-                
-            await bot.send_audio(
-                chat_id=message.chat.id,
-                audio=FSInputFile(audio_path),
-                caption="🎧 Ваш голосовой ответ готов!",
+        # Файл берётся из кэша речи и не удаляется после отправки
+        audio_path = await generate_voice(text, language)
+        if not audio_path:
+            logger.error(f"Failed to generate voice for user_id={user_id}: No audio path returned")
+            await msg.delete()
+            await message.answer(
+                "Не удалось сгенерировать голосовой ответ. Попробуйте другой текст.",
                 reply_markup=cancel_keyboard
             )
+            return
+            
+        await bot.send_audio(
+            chat_id=message.chat.id,
+            audio=FSInputFile(audio_path),
+            caption="🎧 Ваш голосовой ответ готов!",
+            reply_markup=cancel_keyboard
+        )
         
         # Сохраняем в историю
         try:
-            await db.connection.execute(
-                "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)",
-                (user_id, text, "Голосовой ответ сгенерирован", (await state.get_data()).get("session_id", 1))
-            )
-            # Пытаемся обновить audio_requests, но не прерываем выполнение при ошибке
-            try:
-                await db.connection.execute(
-                    "UPDATE profiles SET audio_requests = audio_requests + 1 WHERE user_id = ?",
-                    (user_id,)
-                )
-            except aiosqlite.OperationalError as e:
-                if "no such column: audio_requests" in str(e):
-                    logger.warning(f"Column audio_requests not found for user_id={user_id}, skipping update")
-                else:
-                    logger.error(f"Database error for user_id={user_id}: {e}")
-            await db.connection.commit()
+            session_id = state_data.get("session_id", 1)
+            await save_message_to_history(user_id, text, "Голосовой ответ сгенерирован", session_id, counter="audio")
         except Exception as e:
             logger.error(f"Error saving to history for user_id={user_id}: {e}")
             # Не отправляем сообщение об ошибке, так как аудио уже отправлено
@@ -576,38 +914,32 @@ async def start_image_variations(message: types.Message, state: FSMContext):
     )
 
 @dp.message(UserStates.awaiting_image_variations, F.photo)
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
-async def handle_image_variations(message: types.Message, state: FSMContext):
+async def handle_image_variations(message: types.Message, state_data: StateData):
     user_id = message.from_user.id
-    photo = max(message.photo, key=lambda p: p.width * p.height)
+    # Telegram присылает размеры фото по возрастанию: последний — самый большой
+    photo = message.photo[-1]
     
     msg = await message.answer("🖌 Создаю вариации изображения...")
 
     try:
-        file = await bot.get_file(photo.file_id)
-        file_path = file.file_path
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}") as resp:
-                if resp.status != 200:
-                    raise aiohttp.ClientError(f"Failed to download photo, status: {resp.status}")
-                image_data = await resp.read()
+        # Оригинал скачивается в память: PIL открывает его из BytesIO без временного файла на диске
+        image_data = await bot.download(photo.file_id)
         
-        temp_image_path = Path(IMAGES_DIR) / f"original_{user_id}_{uuid.uuid4().hex}.png"
-        with open(temp_image_path, "wb") as f:
-            f.write(image_data)
-        
-        variations = await create_image_variations(temp_image_path, user_id)
+        variations = await create_image_variations(image_data, user_id)
         
         TELEGRAM_MAX_PHOTO_SIZE = 10 * 1024 * 1024  # 10MB
         media_group = []
-        for i, variation_path in enumerate(variations):
+        for i, (variation_data, (suffix, _)) in enumerate(zip(variations, VARIATION_FILTERS)):
             # Check file size
-            file_size = variation_path.stat().st_size
-            logger.info(f"Variation #{i} for user_id={user_id}, file={variation_path}, size={file_size} bytes")
+            file_size = len(variation_data)
+            logger.info(f"Variation #{i} for user_id={user_id}, filter={suffix}, size={file_size} bytes")
             if file_size > TELEGRAM_MAX_PHOTO_SIZE:
                 logger.error(f"Variation #{i} for user_id={user_id} is too large: {file_size} bytes")
                 raise ValueError(f"Variation #{i} exceeds Telegram's 10MB limit: {file_size} bytes")
-            media_group.append(types.InputMediaPhoto(media=FSInputFile(variation_path), caption=f"Вариация #{i+1}"))
+            media_group.append(types.InputMediaPhoto(
+                media=BufferedInputFile(variation_data, filename=f"variation_{user_id}_{suffix}.png"),
+                caption=f"Вариация #{i+1}"
+            ))
 
         if media_group:
             try:
@@ -621,15 +953,10 @@ async def handle_image_variations(message: types.Message, state: FSMContext):
                 # Optionally, try sending one by one as a fallback or just raise the error
                 raise # Re-raise to indicate failure
         
-        await db.connection.execute(
-            "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)",
-            (user_id, "Создание вариаций изображения", f"Сгенерировано {len(variations)} вариаций", (await state.get_data()).get("session_id", 1))
-        )
-        await db.connection.execute(
-            "UPDATE profiles SET image_requests = image_requests + 1 WHERE user_id = ?",
-            (user_id,)
+        session_id = state_data.get("session_id", 1)
+        await save_message_to_history(
+            user_id, "Создание вариаций изображения", f"Сгенерировано {len(variations)} вариаций", session_id, counter="image"
         )
-        await db.connection.commit()
         await msg.delete()
         
         # Send the cancel keyboard separately if needed, as send_media_group doesn't take reply_markup for the whole group
@@ -637,9 +964,6 @@ async def handle_image_variations(message: types.Message, state: FSMContext):
             "Вариации готовы! Нажмите 👉 Выход, если закончили.",
             reply_markup=cancel_keyboard
         )
-        # Clean up original image
-        if temp_image_path.exists():
-            temp_image_path.unlink()
     except Exception as e:
         logger.error(f"Error creating image variations for user_id={user_id}: {e}")
         await msg.delete()
@@ -647,7 +971,6 @@ async def handle_image_variations(message: types.Message, state: FSMContext):
             f"⚠️ Ошибка создания вариаций изображения: {str(e)}. Попробуйте позже.",
             reply_markup=cancel_keyboard
         )
-        raise  # Re-raise for retry logic
 
 @dp.message(F.text == "🖼️ Сгенерировать (админ)")
 async def admin_generate_image(message: types.Message, state: FSMContext):
@@ -674,14 +997,12 @@ async def process_admin_image_prompt(message: types.Message, state: FSMContext):
     msg = await message.answer("🖼️ Генерирую изображение (админ)...")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            client = AsyncClient(provider=g4f.Provider.ImageLabs)
-            client.session = session
-            response = await client.images.generate(
-                prompt=prompt,
-                model="sdxl-turbo",
-                response_format="url"
-            )
+        response = await admin_image_guard.call(
+            admin_image_client.images.generate,
+            prompt=prompt,
+            model="sdxl-turbo",
+            response_format="url"
+        )
 
         if not response.data or not response.data[0].url:
             raise ValueError("Не удалось получить URL изображения.")
@@ -689,7 +1010,7 @@ async def process_admin_image_prompt(message: types.Message, state: FSMContext):
         image_url = response.data[0].url
         await bot.send_photo(
             chat_id=message.chat.id,
-            photo=image_url,
+            photo=await download_photo(image_url),
             reply_markup=cancel_keyboard
         )
         await msg.delete()
@@ -736,19 +1057,39 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    cursor = await db.connection.execute("SELECT user_id FROM profiles")
-    user_ids = [row[0] for row in await cursor.fetchall()]
+    async def send_broadcast(user_id: int) -> bool:
+        # Частоту отправки ограничивает отдельный broadcast_limiter вместо фиксированной паузы между сообщениями
+        for attempt in range(2):
+            try:
+                async with broadcast_limiter:
+                    await bot.send_message(user_id, broadcast_text)
+                return True
+            except TelegramRetryAfter as e:
+                if attempt:
+                    logger.error(f"Failed to send message to {user_id}: {e}")
+                    return False
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Failed to send message to {user_id}: {e}")
+                return False
 
+    # Получателей читаем страницами по user_id: в памяти не больше одной страницы,
+    # а соединение из пула занято только на время чтения страницы, а не всей рассылки
     successful = 0
     failed = 0
-    for user_id in user_ids:
-        try:
-            await bot.send_message(user_id, broadcast_text)
-            successful += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Failed to send message to {user_id}: {e}")
-            failed += 1
+    last_user_id = 0
+    while True:
+        async with db.reader() as conn:
+            user_ids = [row[0] for row in await conn.execute_fetchall(
+                "SELECT user_id FROM profiles WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (last_user_id, BROADCAST_PAGE_SIZE)
+            )]
+        if not user_ids:
+            break
+        results = await asyncio.gather(*(send_broadcast(user_id) for user_id in user_ids))
+        successful += sum(results)
+        failed += len(results) - sum(results)
+        last_user_id = user_ids[-1]
 
     await message.answer(f"Рассылка завершена. Успешно отправлено: {successful}, не удалось: {failed}.", reply_markup=get_main_keyboard(message.from_user.id))
     await state.clear()
@@ -761,28 +1102,25 @@ async def show_admin_stats(message: types.Message):
         return
 
     try:
-        cursor = await db.connection.execute("""
-            SELECT date, action_type, model_name, SUM(count) as total_count
-            FROM user_stats
-            GROUP BY date, action_type, model_name
-            ORDER BY date DESC, action_type, model_name
-            LIMIT 50
-        """)
-        rows = await cursor.fetchall()
+        async with db.reader() as conn:
+            rows = await conn.execute_fetchall("""
+                SELECT date, action_type, model_name, total_count
+                FROM user_stats_daily
+                ORDER BY date DESC, action_type, model_name
+                LIMIT 50
+            """)
 
         if not rows:
             await message.answer("Статистика пока пуста.")
             return
 
-        stats_text = "📊 <b>Статистика использования</b>\n\n"
-        for row in rows:
-            date, action_type, model_name, total_count = row
-            stats_text += (
-                f"<b>Дата:</b> {date}\n"
-                f"<b>Тип запроса:</b> {action_type}\n"
-                f"<b>Модель:</b> {model_name}\n"
-                f"<b>Количество:</b> {total_count}\n\n"
-            )
+        stats_text = "📊 <b>Статистика использования</b>\n\n" + "".join(
+            f"<b>Дата:</b> {date}\n"
+            f"<b>Тип запроса:</b> {action_type}\n"
+            f"<b>Модель:</b> {model_name}\n"
+            f"<b>Количество:</b> {total_count}\n\n"
+            for date, action_type, model_name, total_count in rows
+        )
 
         await message.answer(stats_text, parse_mode="HTML")
 
@@ -800,31 +1138,28 @@ async def show_user_activity(message: types.Message):
         return
 
     try:
-        cursor = await db.connection.execute("""
-            SELECT p.user_id, p.name, p.gpt_requests, p.image_requests, p.audio_requests, p.created_at, MAX(s.date) as last_activity
-            FROM profiles p
-            LEFT JOIN user_stats s ON p.user_id = s.user_id
-            GROUP BY p.user_id
-            ORDER BY last_activity DESC
-            LIMIT 50
-        """)
-        rows = await cursor.fetchall()
+        async with db.reader() as conn:
+            rows = await conn.execute_fetchall("""
+                SELECT user_id, name, gpt_requests, image_requests, audio_requests,
+                       substr(created_at, 1, 10), last_activity
+                FROM profiles
+                ORDER BY last_activity DESC
+                LIMIT 50
+            """)
 
         if not rows:
             await message.answer("Активность пользователей пока отсутствует.")
             return
 
-        activity_text = "👥 <b>Активность пользователей</b>\n\n"
-        for row in rows:
-            user_id, name, gpt_requests, image_requests, audio_requests, created_at, last_activity = row
-            activity_text += (
-                f"<b>Пользователь:</b> {name} (ID: {user_id})\n"
-                f"<b>GPT-запросов:</b> {gpt_requests}\n"
-                f"<b>Изображений:</b> {image_requests}\n"
-                f"<b>Аудио:</b> {audio_requests}\n"
-                f"<b>Дата регистрации:</b> {created_at[:10]}\n"
-                f"<b>Последняя активность:</b> {last_activity or 'Неизвестно'}\n\n"
-            )
+        activity_text = "👥 <b>Активность пользователей</b>\n\n" + "".join(
+            f"<b>Пользователь:</b> {name} (ID: {user_id})\n"
+            f"<b>GPT-запросов:</b> {gpt_requests}\n"
+            f"<b>Изображений:</b> {image_requests}\n"
+            f"<b>Аудио:</b> {audio_requests}\n"
+            f"<b>Дата регистрации:</b> {created_at or 'Неизвестно'}\n"
+            f"<b>Последняя активность:</b> {last_activity or 'Неизвестно'}\n\n"
+            for user_id, name, gpt_requests, image_requests, audio_requests, created_at, last_activity in rows
+        )
 
         await message.answer(activity_text, parse_mode="HTML")
 
@@ -842,10 +1177,8 @@ async def manage_models(message: types.Message):
         return
 
     try:
-        cursor = await db.connection.execute("SELECT id, name, provider, is_active FROM models ORDER BY name")
-        models = await cursor.fetchall()
-
-        if not models:
+        markup = await get_manage_models_markup()
+        if markup is None:
             await message.answer(
                 "Модели отсутствуют в базе данных.",
                 reply_markup=get_main_keyboard(user_id, is_admin=True)
@@ -855,7 +1188,7 @@ async def manage_models(message: types.Message):
         await message.answer(
             "🛠 <b>Управление моделями</b>\n\nВыберите модель для изменения статуса:",
             parse_mode="HTML",
-            reply_markup=get_manage_models_keyboard(models),
+            reply_markup=markup,
             reply_to_message_id=message.message_id
         )
 
@@ -868,33 +1201,34 @@ async def manage_models(message: types.Message):
 
 @dp.callback_query(F.data.startswith("toggle_model_"))
 async def toggle_model_status(callback: types.CallbackQuery):
+    global active_models_cache, manage_models_keyboard_cache
     user_id = callback.from_user.id
     if user_id not in ADMIN_IDS:
         await callback.answer("⚠️ У вас нет прав для управления моделями.", show_alert=True)
         return
 
     try:
-        model_id = int(callback.data.split("_")[-1])
-        cursor = await db.connection.execute("SELECT is_active FROM models WHERE id = ?", (model_id,))
-        row = await cursor.fetchone()
+        model_id = int(callback.data.rpartition("_")[2])
+        async with db.writer() as conn:
+            # Переключение и чтение нового статуса одним запросом, без отдельного SELECT
+            rows = await conn.execute_fetchall(
+                "UPDATE models SET is_active = 1 - is_active WHERE id = ? RETURNING is_active",
+                (model_id,)
+            )
+            await conn.commit()
+        row = rows[0] if rows else None
         if not row:
             await callback.answer("⚠️ Модель не найдена.", show_alert=True)
             return
 
-        new_status = 0 if row[0] else 1
-        await db.connection.execute(
-            "UPDATE models SET is_active = ? WHERE id = ?",
-            (new_status, model_id)
-        )
-        await db.connection.commit()
-
-        cursor = await db.connection.execute("SELECT id, name, provider, is_active FROM models ORDER BY name")
-        models = await cursor.fetchall()
+        new_status = row[0]
+        active_models_cache = None
+        manage_models_keyboard_cache = None
 
         await callback.message.edit_text(
             "🛠 <b>Управление моделями</b>\n\nВыберите модель для изменения статуса:",
             parse_mode="HTML",
-            reply_markup=get_manage_models_keyboard(models)
+            reply_markup=await get_manage_models_markup()
         )
         await callback.answer(f"Статус модели изменён на {'активна' if new_status else 'неактивна'}.", show_alert=True)
         
@@ -907,7 +1241,7 @@ async def toggle_model_status(callback: types.CallbackQuery):
         )
 
 @dp.message(UserStates.awaiting_audio, F.text)
-async def handle_audio_response(message: types.Message, state: FSMContext):
+async def handle_audio_response(message: types.Message, state: FSMContext, state_data: StateData):
     try:
         user = message.from_user
         if not user:
@@ -917,36 +1251,32 @@ async def handle_audio_response(message: types.Message, state: FSMContext):
             raise ValueError("Message text is empty")
         
         if text == "👉 Выход":
-            await exit_audio_mode(message, state)
+            await exit_audio_mode(message, state, state_data)
             return
 
-        msg = await message.answer("🎙 Генерация аудиоответа...")
+        # История читается из БД, пока отправляется сообщение о генерации
+        context_task = asyncio.create_task(load_session_context(user, state_data))
+        try:
+            msg = await message.answer("🎙 Генерация аудиоответа...")
+        except Exception:
+            context_task.cancel()
+            raise
 
         try:
-            data = await state.get_data()
-            session_id = data.get("session_id", await get_current_session(user.id))
-            
-            prev_msgs = await fetch_user_history(user.id, session_id)
+            session_id, prev_msgs = await context_task
 
             # Формируем историю сообщений для контекста (последние 10 пар)
-            messages = []
-            for hist_msg, hist_reply in prev_msgs[-10:]:
-                messages.extend([
-                    {"role": "user", "content": hist_msg},
-                    {"role": "assistant", "content": hist_reply}
-                ])
-            messages.append({"role": "user", "content": text})
+            messages = build_chat_messages(prev_msgs, text)
             
             current_model = "gpt-4o"
             
-            async with aiohttp.ClientSession() as session:
-                g4f_client.session = session
-                response = await g4f_client.chat.completions.create(
-                    model=current_model,
-                    messages=messages,
-                    temperature=0.7,
-                    max_tokens=2000
-                )
+            response = await g4f_guard.call(
+                g4f_client.chat.completions.create,
+                model=current_model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=2000
+            )
             
             if not response.choices:
                 raise ValueError("Empty response from GPT")
@@ -954,15 +1284,14 @@ async def handle_audio_response(message: types.Message, state: FSMContext):
             text_response = response.choices[0].message.content
             
             async with temp_audio_file(user.id, text) as audio_path:
-                client = AsyncClient(provider=g4f.Provider.PollinationsAI)
-                async with aiohttp.ClientSession() as session:
-                    client.session = session
-                    audio_response = await client.chat.completions.create(
-                        model="openai-audio",
-                        messages=[{"role": "user", "content": text_response}],
-                        audio={"voice": "alloy", "format": "mp3"},
-                    )
-                audio_response.choices[0].message.save(str(audio_path))
+                audio_response = await audio_guard.call(
+                    audio_client.chat.completions.create,
+                    model="openai-audio",
+                    messages=[{"role": "user", "content": text_response}],
+                    audio={"voice": "alloy", "format": "mp3"},
+                )
+                # Запись MP3 на диск — блокирующая операция, выносим её в поток
+                await asyncio.to_thread(audio_response.choices[0].message.save, str(audio_path))
                 await bot.send_audio(
                     chat_id=message.chat.id,
                     audio=FSInputFile(audio_path),
@@ -970,14 +1299,12 @@ async def handle_audio_response(message: types.Message, state: FSMContext):
                     reply_markup=cancel_keyboard
                 )
             
-            await db.connection.execute(
-                "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)",
-                (user.id, text, text_response, session_id)
+            # Ответ записывается в историю только после успешной отправки аудио;
+            # запись идёт параллельно с удалением сообщения о генерации
+            await asyncio.gather(
+                save_message_to_history(user.id, text, text_response, session_id, counter=None),
+                msg.delete(),
             )
-            await db.connection.commit()
-            
-            await state.update_data(session_id=session_id)
-            await msg.delete()
             
         except aiohttp.ClientError as e:
             logger.error(f"Network error generating audio for user_id={user.id}: {e}", exc_info=True)
@@ -1019,8 +1346,7 @@ async def start_image_generation(message: types.Message, state: FSMContext):
     )
 
 @dp.message(UserStates.awaiting_image, F.text)
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
-async def handle_image_generation(message: types.Message, state: FSMContext):
+async def handle_image_generation(message: types.Message, state: FSMContext, state_data: StateData):
     user_id = message.from_user.id
     prompt = message.text.strip()
     
@@ -1041,15 +1367,9 @@ async def handle_image_generation(message: types.Message, state: FSMContext):
         )
         return
 
-    forbidden_keywords = ["обнажённая", "nude", "naked", "adult"]
-    if any(keyword.lower() in prompt.lower() for keyword in forbidden_keywords):
+    if FORBIDDEN_RE.search(prompt):
         await message.answer(
-            "⚠️ Запрос содержит недопустимый контент.\n\n"
-            "Пожалуйста, измените ваш запрос, чтобы он соответствовал правилам.\n\n"
-            "Примеры допустимых запросов:\n"
-            "• 'Красивый закат на пляже'\n"
-            "• 'Кот в шляфе, цифровая живопись'\n"
-            "• 'Футуристический город ночью'",
+            FORBIDDEN_PROMPT_TEXT,
             reply_markup=cancel_keyboard
         )
         return
@@ -1057,14 +1377,12 @@ async def handle_image_generation(message: types.Message, state: FSMContext):
     msg = await message.answer("🎨 Генерация изображения...\nМне нужно немного времени⌛.\nСкоро выведу результат👇")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            client = AsyncClient(provider=g4f.Provider.ARTA)
-            client.session = session
-            response = await client.images.generate(
-                model="yamers_realistic_xl" if "yamers_realistic_xl" in [m[1] for m in g4f.Provider.ARTA.models] else "realistic_stock_xl",
-                prompt=prompt,
-                response_format="url",
-            )
+        response = await image_guard.call(
+            image_client.images.generate,
+            model=ARTA_IMAGE_MODEL,
+            prompt=prompt,
+            response_format="url",
+        )
         logger.info(f"Image generation response: {response}")
         
         if not hasattr(response, 'data') or not response.data:
@@ -1074,20 +1392,17 @@ async def handle_image_generation(message: types.Message, state: FSMContext):
             logger.error("Response data[0] missing 'url' attribute")
             raise ValueError("Invalid response structure from provider")
             
-        await bot.send_photo(
-            chat_id=message.chat.id,
-            photo=response.data[0].url,
-            reply_markup=cancel_keyboard
-        )
-        await db.connection.execute(
-            "UPDATE profiles SET image_requests = image_requests + 1 WHERE user_id = ?",
-            (user_id,)
-        )
-        await db.connection.execute(
-            "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)",
-            (user_id, prompt, "Изображение сгенерировано", (await state.get_data()).get("session_id", 1))
+        photo = await download_photo(response.data[0].url)
+        session_id = state_data.get("session_id", 1)
+        # Загрузка фото в Telegram и запись в историю не зависят друг от друга
+        await asyncio.gather(
+            bot.send_photo(
+                chat_id=message.chat.id,
+                photo=photo,
+                reply_markup=cancel_keyboard
+            ),
+            save_message_to_history(user_id, prompt, "Изображение сгенерировано", session_id, counter="image"),
         )
-        await db.connection.commit()
         await msg.delete()
     except aiohttp.ClientError as e:
         logger.error(f"Network error generating image for user_id={user_id}: {e}", exc_info=True)
@@ -1102,12 +1417,7 @@ async def handle_image_generation(message: types.Message, state: FSMContext):
         if "Invalid prompts detected" in error_message or "error_code\":769" in error_message:
             await msg.delete()
             await message.answer(
-                "⚠️ Извините, мне запрещено генерировать изображения по такому запросу.\n\n"
-                "Пожалуйста, измените ваш запрос, чтобы он не содержал запрещённых тем или формулировок.\n\n"
-                "Примеры допустимых запросов:\n"
-                "• 'Красивый закат на пляже'\n"
-                "• 'Кот в шляфе, цифровая живопись'\n"
-                "• 'Футуристический город ночью'",
+                IMAGE_PROMPT_REJECTED_TEXT,
                 reply_markup=cancel_keyboard
             )
         else:
@@ -1116,19 +1426,13 @@ async def handle_image_generation(message: types.Message, state: FSMContext):
                 f"⚠️ Ошибка провайдера: {error_message}",
                 reply_markup=cancel_keyboard
             )
-        raise
     except g4f.Provider.ProviderError as e:
         logger.error(f"Provider error generating image for user_id={user_id}: {e}", exc_info=True)
         error_message = str(e)
         if "Invalid prompts detected" in error_message or "error_code\":769" in error_message:
             await msg.delete()
             await message.answer(
-                "⚠️ Извините, мне запрещено генерировать изображения по такому запросу.\n\n"
-                "Пожалуйста, измените ваш запрос, чтобы он не содержал запрещённых тем или формулировок.\n\n"
-                "Примеры допустимых запросов:\n"
-                "• 'Красивый закат на пляже'\n"
-                "• 'Кот в шляфе, цифровая живопись'\n"
-                "• 'Футуристический город ночью'",
+                IMAGE_PROMPT_REJECTED_TEXT,
                 reply_markup=cancel_keyboard
             )
         else:
@@ -1137,29 +1441,18 @@ async def handle_image_generation(message: types.Message, state: FSMContext):
                 f"⚠️ Ошибка провайдера: {error_message}",
                 reply_markup=cancel_keyboard
             )
-        raise
     except ValueError as e:
         logger.error(f"ValueError in image generation for user_id={user_id}: {e}", exc_info=True)
         await msg.delete()
         await message.answer(
-            "⚠️ Ошибка обработки ответа от провайдера. Возможно, запрос содержит недопустимый контент.\n\n"
-            "Пожалуйста, измените ваш запрос, чтобы он соответствовал правилам.\n\n"
-            "Примеры допустимых запросов:\n"
-            "• 'Красивый закат на пляже'\n"
-            "• 'Кот в шляфе, цифровая живопись'\n"
-            "• 'Футуристический город ночью'",
+            IMAGE_RESPONSE_ERROR_TEXT,
             reply_markup=cancel_keyboard
         )
     except AttributeError as e:
         logger.error(f"AttributeError in image generation for user_id={user_id}: {e}", exc_info=True)
         await msg.delete()
         await message.answer(
-            "⚠️ Ошибка обработки ответа от провайдера. Возможно, запрос содержит недопустимый контент.\n\n"
-            "Пожалуйста, измените ваш запрос, чтобы он соответствовал правилам.\n\n"
-            "Примеры допустимых запросов:\n"
-            "• 'Красивый закат на пляже'\n"
-            "• 'Кот в шляфе, цифровая живопись'\n"
-            "• 'Футуристический город ночью'",
+            IMAGE_RESPONSE_ERROR_TEXT,
             reply_markup=cancel_keyboard
         )
     except Exception as e:
@@ -1170,29 +1463,31 @@ async def handle_image_generation(message: types.Message, state: FSMContext):
             reply_markup=cancel_keyboard
         )
 
+async def fetch_profile_row(user_id: int):
+    """Возвращает (name, gpt_requests, image_requests, audio_requests, created_at) профиля или None."""
+    async with db.reader() as conn:
+        rows = await conn.execute_fetchall("""
+            SELECT name, gpt_requests, image_requests, audio_requests, substr(created_at, 1, 19)
+            FROM profiles WHERE user_id = ?
+        """, (user_id,))
+    return rows[0] if rows else None
+
 @dp.message(F.text == "👤 Профиль")
 async def show_profile(message: types.Message, state: FSMContext):
     await state.clear()
     user_id = message.from_user.id
-    cursor = await db.connection.execute("""
-        SELECT name, gpt_requests, image_requests, audio_requests, created_at
-        FROM profiles WHERE user_id = ?
-    """, (user_id,))
-    row = await cursor.fetchone()
+    row = await fetch_profile_row(user_id)
     
     if not row:
-        await ensure_profile(message.from_user)
-        cursor = await db.connection.execute("""
-            SELECT name, gpt_requests, image_requests, audio_requests, created_at
-            FROM profiles WHERE user_id = ?
-        """, (user_id,))
-        row = await cursor.fetchone()
+        # Новый профиль возвращается самой вставкой. None означает, что профиль уже существует
+        # (например, его успел создать параллельный запрос) — тогда читаем его повторно
+        row = await ensure_profile(message.from_user) or await fetch_profile_row(user_id)
     
     name, gpt_count, img_count, audio_count, created_at_val = row
-    current_model = await get_user_model(user_id)
+    current_model = await get_user_model(message.from_user)
     
-    # Более надежная проверка перед срезом
-    created_at_str = created_at_val[:19] if created_at_val and isinstance(created_at_val, str) else "Неизвестно"
+    # Дата обрезается до секунд в SQL; для старых профилей без даты выводим заглушку
+    created_at_str = created_at_val or "Неизвестно"
     await message.answer(
         f"<b>👤 Профиль</b>\n\n"
         f"<b>Имя:</b> {name}\n"
@@ -1206,15 +1501,14 @@ async def show_profile(message: types.Message, state: FSMContext):
         reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS))
 
 @dp.message(F.text == "🔄 Новый чат")
-async def new_chat(message: types.Message, state: FSMContext):
+async def new_chat(message: types.Message, state: FSMContext, state_data: StateData):
     user_id = message.from_user.id
     
     await state.clear()
     
-    new_session = await get_current_session(user_id)
-    await state.update_data(session_id=new_session)
-    
-    await state.update_data(history_message_ids=[])
+    new_session = await get_current_session(message.from_user)
+    state_data.set("session_id", new_session)
+    state_data.set("history_message_ids", [])
     
     await message.answer(
         "🔄 <b>Новый чат начат</b>\n"
@@ -1232,10 +1526,8 @@ async def start_web_search(message: types.Message, state: FSMContext):
         reply_markup=cancel_keyboard
     )
 
-async def exit_search_mode(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    session_id = data.get("session_id", await get_current_session(message.from_user.id))
-    await state.update_data(session_id=session_id)
+async def exit_search_mode(message: types.Message, state: FSMContext, state_data: StateData):
+    await get_session_id(message.from_user, state_data)
     await state.set_state(None)
     await message.answer(
         "Вы вышли из режима поиска в интернете.",
@@ -1243,10 +1535,9 @@ async def exit_search_mode(message: types.Message, state: FSMContext):
     )
 
 @dp.message(UserStates.awaiting_search_query, F.text)
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
-async def handle_web_search(message: types.Message, state: FSMContext):
+async def handle_web_search(message: types.Message, state: FSMContext, state_data: StateData):
     if message.text == "👉 Выход":
-        await exit_search_mode(message, state)
+        await exit_search_mode(message, state, state_data)
         return
         
     search_query = message.text.strip()
@@ -1258,30 +1549,34 @@ async def handle_web_search(message: types.Message, state: FSMContext):
             reply_markup=cancel_keyboard
         )
         return
+
+    if is_duplicate_request(message, search_query):
+        logger.info(f"Skipping duplicate search from {user_id}")
+        await message.answer("⌛ Этот запрос уже получен, повторять не нужно.", reply_markup=cancel_keyboard)
+        return
     
     msg = await message.answer("🔍 Выполняю поиск...\nМне нужно немного времени⌛.\nСкоро выведу результат👇")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            g4f_client.session = session
-            response = await g4f_client.chat.completions.create(
-                model="gpt-4",
-                messages=[{"role": "user", "content": search_query}],
-                tool_calls=[{
-                    "function": {
-                        "arguments": {
-                            "query": search_query,
-                            "max_results": 5,
-                            "max_words": 2500,
-                            "backend": "auto",
-                            "add_text": True,
-                            "timeout": 5
-                        },
-                        "name": "search_tool"
+        response = await g4f_guard.call(
+            g4f_client.chat.completions.create,
+            model="gpt-4",
+            messages=[{"role": "user", "content": search_query}],
+            tool_calls=[{
+                "function": {
+                    "arguments": {
+                        "query": search_query,
+                        "max_results": 5,
+                        "max_words": 2500,
+                        "backend": "auto",
+                        "add_text": True,
+                        "timeout": 5
                     },
-                    "type": "function"
-                }]
-            )
+                    "name": "search_tool"
+                },
+                "type": "function"
+            }]
+        )
 
         if response.choices and response.choices[0].message.content:
             search_results = response.choices[0].message.content
@@ -1291,16 +1586,11 @@ async def handle_web_search(message: types.Message, state: FSMContext):
                 parse_mode="HTML"
             )
             
-            data = await state.get_data()
-            session_id = data.get("session_id", await get_current_session(user_id))
+            session_id = await get_session_id(message.from_user, state_data)
             logger.debug(f"Saving search to history: user_id={user_id}, query={search_query}, results={search_results[:50]}..., session_id={session_id}")
-            await db.connection.execute(
-                "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)",
-                (user_id, search_query, search_results, session_id)
-            )
-            await db.connection.commit()
+            await save_message_to_history(user_id, search_query, search_results, session_id, counter=None)
             
-            await state.update_data(session_id=session_id)
+            state_data.set("session_id", session_id)
             await msg.delete()
         else:
             await msg.delete()
@@ -1316,22 +1606,21 @@ async def handle_web_search(message: types.Message, state: FSMContext):
         await message.answer(f"⚠️ Ошибка поиска: {str(e)}", reply_markup=cancel_keyboard)
 
 @dp.message(F.photo)
-async def handle_uploaded_photo(message: types.Message, state: FSMContext):
+async def handle_uploaded_photo(message: types.Message, state: FSMContext, state_data: StateData):
     user_id = message.from_user.id
     logger.info(f"[handle_uploaded_photo] Получено фото от user_id={user_id}")
 
     # Сбрасываем флаг "обрабатывается", если застрял
-    data = await state.get_data()
-    if data.get("processing_photo"):
+    if state_data.get("processing_photo"):
         logger.warning(f"[handle_uploaded_photo] Обнаружено зависшее состояние обработки, сбрасываю.")
-        await state.update_data(processing_photo=False)
+        state_data.set("processing_photo", False)
 
     try:
-        photo = max(message.photo, key=lambda p: p.width * p.height)
+        photo = message.photo[-1]
         photo_file_id = photo.file_id
 
-        await state.update_data(photo_file_id=photo_file_id)
-        await state.update_data(processing_photo=True)
+        state_data.set("photo_file_id", photo_file_id)
+        state_data.set("processing_photo", True)
 
         logger.info(f"[handle_uploaded_photo] Сохранён photo_file_id={photo_file_id}")
 
@@ -1350,25 +1639,25 @@ async def handle_uploaded_photo(message: types.Message, state: FSMContext):
 
 
 @dp.message(UserStates.awaiting_image_prompt, F.text)
-async def handle_image_prompt(message: types.Message, state: FSMContext):
+async def handle_image_prompt(message: types.Message, state: FSMContext, state_data: StateData):
     user_id = message.from_user.id
+    is_admin = user_id in ADMIN_IDS
     prompt = message.text.strip()
     
     if not prompt:
         await state.clear()
-        await state.update_data(processing_photo=False)
+        state_data.set("processing_photo", False)
         await message.answer(
             "Пожалуйста, укажите, что нужно сделать с изображением.",            
             reply_markup=get_main_keyboard(user_id)
         )
         return
 
-    data = await state.get_data()
-    photo_file_id = data.get("photo_file_id")
+    photo_file_id = state_data.get("photo_file_id")
     if not photo_file_id:
         logger.warning(f"photo_file_id not found for user_id={user_id}, prompt={prompt}")
         await state.clear()
-        await state.update_data(processing_photo=False)
+        state_data.set("processing_photo", False)
         await message.answer(
             "⚠️ Ошибка: изображение не найдено. Пожалуйста, загрузите фото заново.",            
             reply_markup=get_main_keyboard(user_id)
@@ -1378,61 +1667,47 @@ async def handle_image_prompt(message: types.Message, state: FSMContext):
     msg = await message.answer("📷 Обрабатываю изображение...\nМне нужно немного времени⌛.\nСкоро выведу результат👇")
 
     try:
-        file = await bot.get_file(photo_file_id)
-        file_path = file.file_path
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}") as resp:
-                if resp.status != 200:
-                    raise aiohttp.ClientError(f"Failed to download photo, status: {resp.status}")
-                image_data = await resp.read()
-
-        session_id = data.get("session_id", await get_current_session(user_id))
-        prev_msgs = await fetch_user_history(user_id, session_id)
+        # Фото скачивается через пул соединений сессии бота в память
+        image_data = (await bot.download(photo_file_id)).getvalue()
+
+        session_id = await get_session_id(message.from_user, state_data)
+        prev_msgs = await fetch_user_history(user_id, session_id, limit=5)
         
-        context = ""
-        for hist_msg, hist_reply in prev_msgs[-5:]:
-            context += f"User: {hist_msg}\nAssistant: {hist_reply}\n"
+        context = "".join(f"User: {hist_msg}\nAssistant: {hist_reply}\n" for hist_msg, hist_reply in trim_history(prev_msgs))
         if context:
             full_prompt = f"Previous conversation:\n{context}\nCurrent request: {prompt}"
         else:
             full_prompt = prompt
 
-        async with aiohttp.ClientSession() as session:
-            g4f_client.session = session
-            response = await g4f_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": full_prompt}],
-                image=image_data
-            )
+        response = await g4f_guard.call(
+            g4f_client.chat.completions.create,
+            model="gpt-4o",
+            messages=[{"role": "user", "content": full_prompt}],
+            image=image_data
+        )
 
         if not response.choices:
             raise ValueError("Empty response from GPT")
 
         description = response.choices[0].message.content
 
-        await db.connection.execute(
-            "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)",
-            (user_id, f"Обработка изображения: {prompt}", description, session_id)
-        )
-        await db.connection.execute(
-            "UPDATE profiles SET gpt_requests = gpt_requests + 1 WHERE user_id = ?",
-            (user_id,)
-        )
-        await db.connection.commit()
-
-        await message.answer(
-            f"📷 Результат обработки:\n\n{description}",
-            reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS),
-            parse_mode="HTML"
+        # Запись в историю не задерживает ответ: все три операции независимы
+        await asyncio.gather(
+            save_message_to_history(user_id, f"Обработка изображения: {prompt}", description, session_id),
+            message.answer(
+                f"📷 Результат обработки:\n\n{description}",
+                reply_markup=get_main_keyboard(user_id, is_admin=is_admin),
+                parse_mode="HTML"
+            ),
+            msg.delete(),
         )
-        await msg.delete()
 
     except aiohttp.ClientError as e:
         logger.error(f"Network error in image processing for user_id={user_id}: {e}", exc_info=True)
         await msg.delete()
         await message.answer(
             "⚠️ Ошибка сети. Попробуйте позже.",
-            reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS)
+            reply_markup=get_main_keyboard(user_id, is_admin=is_admin)
         )
     except g4f.Provider.ProviderError as e:
         logger.error(f"Provider error in image processing for user_id={user_id}: {e}", exc_info=True)
@@ -1446,35 +1721,39 @@ async def handle_image_prompt(message: types.Message, state: FSMContext):
         await msg.delete()
         await message.answer(
             "⚠️ Неизвестная ошибка. Попробуйте позже.",
-            reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS)
+            reply_markup=get_main_keyboard(user_id, is_admin=is_admin)
         )
     finally:
-        await state.update_data(processing_photo=False)
+        state_data.set("processing_photo", False)
         await state.set_state(None)
 
 @dp.message(F.video | F.document)
-async def unsupported_media_handler(message: types.Message, state: FSMContext):
-    await message.answer(
-        "⚠️ Извините, я пока не умею работать с видео или файлами. "
-        "Пожалуйста, отправьте текстовое сообщение или изображение.",
-        reply_markup=get_main_keyboard(message.from_user.id)
-    )
+async def unsupported_media_handler(message: types.Message):
+    # На пачку файлов отвечаем один раз: повторные сообщения в течение минуты игнорируются
+    if message.chat.id in unsupported_media_warned:
+        return
+    unsupported_media_warned[message.chat.id] = True
+    await message.answer(UNSUPPORTED_MEDIA_TEXT, reply_markup=get_main_keyboard(message.from_user.id))
 
 @dp.callback_query(F.data.startswith("set_model_"))
-async def set_model_callback(callback: types.CallbackQuery, state: FSMContext):
-    model_id = int(callback.data.split("_")[-1])
+async def set_model_callback(callback: types.CallbackQuery):
+    model_id = int(callback.data.rpartition("_")[2])
     user_id = callback.from_user.id
 
     try:
-        await db.connection.execute(
-            "UPDATE user_settings SET model_id = ? WHERE user_id = ?",
-            (model_id, user_id)
-        )
-        await db.connection.commit()
-
-        data = await state.get_data()
-        session_id = data.get("session_id", await get_current_session(user_id))
-        await state.update_data(session_id=session_id)
+        async with db.writer() as conn:
+            # RETURNING отдаёт название новой модели, чтобы сразу записать его в кэш
+            rows = await conn.execute_fetchall(
+                "UPDATE user_settings SET model_id = ? WHERE user_id = ? "
+                "RETURNING (SELECT name FROM models WHERE id = user_settings.model_id)",
+                (model_id, user_id)
+            )
+            await conn.commit()
+        model_name = rows[0][0] if rows else None
+        if model_name:
+            user_model_cache[user_id] = model_name
+        else:
+            user_model_cache.pop(user_id, None)
 
         await callback.message.edit_text("✅ Модель успешно изменена!")
         await show_settings_from_query(callback)
@@ -1494,26 +1773,28 @@ async def back_to_main_callback(callback: types.CallbackQuery, state: FSMContext
     user_id = callback.from_user.id
     is_admin = user_id in ADMIN_IDS
     await state.clear()
-    await callback.message.answer(
-        "Вы находитесь в главном меню.",
-        reply_markup=get_main_keyboard(user_id, is_admin=is_admin)
+    # Вызовы Telegram не зависят друг от друга — выполняем их параллельно
+    await asyncio.gather(
+        callback.message.answer(
+            "Вы находитесь в главном меню.",
+            reply_markup=get_main_keyboard(user_id, is_admin=is_admin)
+        ),
+        callback.message.delete(),
+        callback.answer(),
     )
-    await callback.message.delete(reply_markup=cancel_keyboard)
-    await callback.message.delete()
-    await callback.answer()
 
 @dp.callback_query(F.data.startswith("convert_to_voice_"))
-async def handle_convert_to_voice(callback: types.CallbackQuery, state: FSMContext):
+async def handle_convert_to_voice(callback: types.CallbackQuery, state_data: StateData):
     user_id = callback.from_user.id
+    is_admin = user_id in ADMIN_IDS
 
     # callback.data is structured as "convert_to_voice_{USER_MESSAGE_ID}_{PART_INDEX}"
-    # The text itself is stored in FSM context with a key like "{BOT_MESSAGE_ID}_{PART_INDEX}"
+    # The text itself is stored in voice_text_cache with a key (CHAT_ID, BOT_MESSAGE_ID, PART_INDEX)
     # We need to reconstruct this key.
 
-    try:
-        # The last part of the callback_data string is the part_index
-        part_index_str = callback.data.split("_")[-1]
-    except IndexError:
+    # The last part of the callback_data string is the part_index
+    part_index_str = callback.data.rpartition("_")[2]
+    if not part_index_str.isdigit():
         logger.error(f"Could not parse part_index from callback_data: {callback.data} for user_id={user_id}")
         await callback.message.edit_text("⚠️ Ошибка: неверный формат данных для кнопки.")
         await callback.answer()
@@ -1523,15 +1804,12 @@ async def handle_convert_to_voice(callback: types.CallbackQuery, state: FSMConte
     bot_message_id = callback.message.message_id
     
     # This is the key used when storing the text in handle_message
-    fsm_storage_key = f"{bot_message_id}_{part_index_str}"
+    cache_key = (callback.message.chat.id, bot_message_id, int(part_index_str))
 
-    # Retrieve the stored response from FSM context
-    data = await state.get_data()
-    responses = data.get("response_texts", {})
-    text = responses.get(fsm_storage_key)
+    text = voice_text_cache.get(cache_key)
 
     if not text:
-        logger.warning(f"Text not found for FSM key '{fsm_storage_key}'. Callback data: '{callback.data}'. Available keys in FSM: {list(responses.keys())} for user_id={user_id}")
+        logger.warning(f"Text not found for key {cache_key}. Callback data: '{callback.data}' for user_id={user_id}")
         await callback.message.edit_text("⚠️ Не удалось найти текст для преобразования в голос.")
         await callback.answer()
         return
@@ -1540,52 +1818,49 @@ async def handle_convert_to_voice(callback: types.CallbackQuery, state: FSMConte
 
     try:
         # Determine language based on text content
-        language = "ru" if any(c in text.lower() for c in "абвгдеёжзийклмнопрстуфхцчшщъыьэюя") else "en"
+        language = "ru" if CYRILLIC_RE.search(text) else "en"
 
         # Generate voice file
-        async with temp_audio_file(user_id, text) as audio_path:
-            audio_path = await generate_voice(text, language)
-            if not audio_path:
-                logger.error(f"Failed to generate voice for user_id={user_id}: No audio path returned")
-                await msg.delete()
-                await callback.message.answer(
-                    "Не удалось сгенерировать голосовой ответ. Попробуйте позже.",
-                    reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS)
-                )
-                return
-
-            await bot.send_audio(
-                chat_id=callback.message.chat.id,
-                audio=FSInputFile(audio_path),
-                caption="🎧 Ваш голосовой ответ готов!",
-                reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS)
+        # Файл берётся из кэша речи и не удаляется после отправки
+        audio_path = await generate_voice(text, language)
+        if not audio_path:
+            logger.error(f"Failed to generate voice for user_id={user_id}: No audio path returned")
+            await msg.delete()
+            await callback.message.answer(
+                "Не удалось сгенерировать голосовой ответ. Попробуйте позже.",
+                reply_markup=get_main_keyboard(user_id, is_admin=is_admin)
             )
+            return
 
-        # Save to history
-        try:
-            session_id = data.get("session_id", await get_current_session(user_id))
-            await db.connection.execute(
-                "INSERT INTO history (user_id, message, reply, session_id) VALUES (?, ?, ?, ?)",
-                (user_id, "Перевод ответа в голос", "Голосовой ответ сгенерирован", session_id)
-            )
-            await db.connection.execute(
-                "UPDATE profiles SET audio_requests = audio_requests + 1 WHERE user_id = ?",
-                (user_id,)
-            )
-            await db.connection.commit()
-        except Exception as e:
-            logger.error(f"Error saving voice conversion to history for user_id={user_id}: {e}")
+        await bot.send_audio(
+            chat_id=callback.message.chat.id,
+            audio=FSInputFile(audio_path),
+            caption="🎧 Ваш голосовой ответ готов!",
+            reply_markup=get_main_keyboard(user_id, is_admin=is_admin)
+        )
 
-        await msg.delete()
-        await callback.message.edit_reply_markup(reply_markup=None)  # Remove the inline button
-        await callback.answer()
+        # Save to history
+        async def record_voice_turn():
+            try:
+                session_id = await get_session_id(callback.from_user, state_data)
+                await save_message_to_history(user_id, "Перевод ответа в голос", "Голосовой ответ сгенерирован", session_id, counter="audio")
+            except Exception as e:
+                logger.error(f"Error saving voice conversion to history for user_id={user_id}: {e}")
+
+        # Запись в БД и завершающие вызовы Telegram независимы — выполняем их параллельно
+        await asyncio.gather(
+            record_voice_turn(),
+            msg.delete(),
+            callback.message.edit_reply_markup(reply_markup=None),  # Remove the inline button
+            callback.answer(),
+        )
 
     except Exception as e:
         logger.error(f"Unexpected error generating voice for user_id={user_id}: {e}")
         await msg.delete()
         await callback.message.answer(
             "Не удалось сгенерировать голосовой ответ. Попробуйте позже.",
-            reply_markup=get_main_keyboard(user_id, is_admin=user_id in ADMIN_IDS)
+            reply_markup=get_main_keyboard(user_id, is_admin=is_admin)
         )
         await callback.message.edit_reply_markup(reply_markup=None)
         await callback.answer()
@@ -1595,16 +1870,22 @@ async def handle_convert_to_voice(callback: types.CallbackQuery, state: FSMConte
 # Срабатывает только когда нет активного FSM-состояния (пользователь не в спецрежиме)
 # ---------------------------------------------------------------------------
 @dp.message(F.text)
-async def handle_message(message: types.Message, state: FSMContext):
-    # Если пользователь находится в каком-либо специальном режиме — не обрабатываем здесь
-    if await state.get_state() is not None:
-        return
-        
+async def handle_message(message: types.Message, state: FSMContext, state_data: StateData):
     user = message.from_user
     text = message.text.strip()
     user_id = user.id
 
-    if text.startswith('/'):
+    # Сначала дешёвые проверки текста, и только потом обращение к хранилищу FSM
+    if not text or text.startswith('/'):
+        return
+
+    # Если пользователь находится в каком-либо специальном режиме — не обрабатываем здесь
+    if await state.get_state() is not None:
+        return
+
+    if is_duplicate_request(message, text):
+        logger.info(f"Skipping duplicate message from {user_id}")
+        await message.answer("⌛ Этот запрос уже получен, повторять не нужно.")
         return
         
     logger.info(f"New message from {user_id}: {text[:100]}...")
@@ -1612,78 +1893,90 @@ async def handle_message(message: types.Message, state: FSMContext):
     try:
         await ensure_profile(user)
         
-        data = await state.get_data()
-        session_id = data.get("session_id")
-        if not session_id:
-            session_id = await get_current_session(user_id)
-            await state.update_data(session_id=session_id)
+        session_id = await get_session_id(user, state_data)
         
         await bot.send_chat_action(message.chat.id, "typing")
         
         prev_msgs = await fetch_user_history(user_id, session_id)
         
         # Формируем историю для AI-контекста (последние 10 пар вопрос/ответ)
-        messages = []
-        for hist_msg, hist_reply in prev_msgs[-10:]:
-            messages.extend([
-                {"role": "user", "content": hist_msg},
-                {"role": "assistant", "content": hist_reply}
-            ])
-        messages.append({"role": "user", "content": text})
+        messages = build_chat_messages(prev_msgs, text)
 
-        current_model = await get_user_model(user_id)
+        current_model = await get_user_model(user)
 
         msg = await message.answer("💬 Обрабатываю запрос...")
-        
-        async with aiohttp.ClientSession() as session:
-            g4f_client.session = session
-            response = await g4f_client.chat.completions.create(
+
+        # Ответ берётся из кэша только для повтора собственного недавнего вопроса пользователя
+        cache_key = (user_id, current_model, normalize_prompt(text))
+        full_reply = reply_cache.get(cache_key)
+        if full_reply is None:
+            response = await g4f_guard.call(
+                g4f_client.chat.completions.create,
                 model=current_model,
                 messages=messages,
                 temperature=0.7,
                 max_tokens=2000
             )
-        
-        if not response.choices:
-            raise ValueError("Empty response from GPT")
             
-        full_reply = response.choices[0].message.content
-        
-        await save_message_to_history(user_id, text, full_reply, session_id)
+            if not response.choices:
+                raise ValueError("Empty response from GPT")
+                
+            full_reply = response.choices[0].message.content
+            if full_reply:
+                reply_cache[cache_key] = full_reply
+        else:
+            logger.info(f"Reply cache hit for user_id={user_id}")
         
         try:
             await msg.delete()
         except Exception:
             pass
             
-        # Store responses for voice conversion
-        response_texts = data.get("response_texts", {})
-        
-        for i in range(0, len(full_reply), MAX_MESSAGE_LENGTH):
-            part = full_reply[i:i + MAX_MESSAGE_LENGTH]
-            if len(full_reply) > MAX_MESSAGE_LENGTH:
-                part = f"({i//MAX_MESSAGE_LENGTH + 1}/{len(full_reply)//MAX_MESSAGE_LENGTH + 1})\n\n{part}"
-                
-            # Create inline keyboard with "Перевести в голос" button
-            builder = InlineKeyboardBuilder()
-            builder.add(InlineKeyboardButton(text="🔊 Перевести в голос", callback_data=f"convert_to_voice_{message.message_id}_{i//MAX_MESSAGE_LENGTH}"))
+        # Разбиваем ответ на части один раз. У длинного ответа каждая часть получает заголовок "(i/N)",
+        # поэтому место под него вычитаем из размера части, чтобы не превысить лимит Telegram
+        if len(full_reply) > MAX_MESSAGE_LENGTH:
+            chunk_size = MAX_MESSAGE_LENGTH - PART_HEADER_RESERVE
+            chunks = [full_reply[i:i + chunk_size] for i in range(0, len(full_reply), chunk_size)]
+            total = len(chunks)
+            parts = [f"({idx}/{total})\n\n{chunk}" for idx, chunk in enumerate(chunks, 1)]
+        else:
+            parts = [full_reply]
+
+        async def record_text_turn():
+            try:
+                await save_message_to_history(user_id, text, full_reply, session_id, stats_model=current_model)
+            except Exception as e:
+                logger.error(f"Error saving message to history for user_id={user_id}: {e}")
+
+        # История пишется параллельно с отправкой ответа. Запись дожидаемся и при ошибке отправки,
+        # чтобы задача не осталась без присмотра. Ошибка записи только логируется: ответ пользователь уже получил
+        save_task = asyncio.create_task(record_text_turn())
+        try:
+            for part_index, part in enumerate(parts):
+                # Клавиатура из одной кнопки "Перевести в голос" собирается напрямую, без InlineKeyboardBuilder
+                voice_markup = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+                    text=VOICE_BUTTON_TEXT, callback_data=f"convert_to_voice_{message.message_id}_{part_index}"
+                )]])
             
-            sent_message = await message.answer(
-                part,
-                reply_markup=builder.as_markup(),
-                parse_mode="HTML"
-            )
+                # Части отправляются по очереди, чтобы сохранить порядок в чате;
+                # общий лимитер не даёт длинным ответам упереться в лимит Bot API
+                async with telegram_limiter:
+                    sent_message = await message.answer(
+                        part,
+                        reply_markup=voice_markup,
+                        parse_mode="HTML"
+                    )
             
-            # Store the part of the response with a unique key
-            response_texts[f"{sent_message.message_id}_{i//MAX_MESSAGE_LENGTH}"] = part
-            await state.update_data(response_texts=response_texts)
-        
-        await db.connection.execute(
-            "INSERT INTO user_stats (user_id, date, action_type, model_name, count) VALUES (?, ?, ?, ?, ?) "
-            "ON CONFLICT(user_id, date, action_type, model_name) DO UPDATE SET count = count + 1",
-            (user_id, str(datetime.now().date()), "text", current_model, 1)
-        )
+                # Store the part of the response with a unique key
+                voice_text_cache[(message.chat.id, sent_message.message_id, part_index)] = part
+        finally:
+            await save_task
             
+    except (ProviderBusyError, CircuitOpenError) as e:
+        # Перегрузка или отключённый провайдер: отвечаем сразу, без ожидания в очереди
+        logger.warning(f"Provider unavailable for user_id={user_id}: {e}")
+        await message.answer(f"⚠️ {e}", reply_markup=get_main_keyboard(user_id))
+
     except aiohttp.ClientError as e:
         logger.error(f"Network error: {e}", exc_info=True)
         await message.answer(
@@ -1710,8 +2003,9 @@ async def main():
     logger.info("Database initialized")
     try:
         logger.info("Starting polling...")
-        # Polling — бот регулярно запрашивает новые обновления с серверов Telegram
-        await dp.start_polling(bot)
+        # Polling — бот регулярно запрашивает новые обновления с серверов Telegram.
+        # handle_as_tasks: каждое обновление — отдельная задача, порядок внутри чата держит ChatQueueMiddleware
+        await dp.start_polling(bot, handle_as_tasks=True)
     finally:
         await db.close()
         logger.info("Bot stopped")
@@ -33,3 +33,31 @@ INSTRUCTION_TEXT = """
 • Для распознавания фото отправляйте четкие изображения
 • Для вариаций изображений загружайте фото и следуйте инструкциям
 """
+
+# Приветствие /start; {name} подставляется через str.format
+GREETING_TEMPLATE = """Привет, <b>{name}</b>! 👋\n\n
+        Я — умный бот на основе GPT-4, готовый помочь с различными задачами.  
+
+<b>Что я умею?</b>  
+✨ Отвечать на вопросы по разным темам
+🎙 Генерировать голосовые ответы
+🔊 Переводить текстовые ответы в голос
+💻 Помогать с программированием и кодом
+🎨 Генерировать изображения по описанию
+🖌 Создавать вариации изображений
+🖼 Обрабатывать изображения
+🎭 Поддерживать интерактивные сценарии 
+
+<b>Как мной пользоваться?</b>  
+Просто напиши мне сообщение — я постараюсь помочь!  
+Для генерации изображения нажми кнопку <b>🎨 Генерация изображения</b>.
+Для создания вариаций изображения нажми <b>🖌 Вариации изображения</b>.
+Для генерации аудиоответа нажми кнопку <b>"🎙 Ответ голосом"</b>.  
+Для перевода текста в голос нажми <b>"🔊 Перевести в голос"</b>.
+Для поиска в интернете нажми кнопку <b>"🌐 Поиск в интернете"</b>.
+Для настройки параметров нажми кнопку <b>"⚙️ Настройки"</b>.
+Для выхода из чата нажми кнопку <b>"👉 Выход"</b>.
+Для просмотра истории сообщений нажми кнопку <b>"🕓 История"</b>.
+Для просмотра своего профиля нажми кнопку <b>"👤 Профиль"</b>. 
+
+Начнём? 😊"""
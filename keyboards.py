@@ -1,8 +1,14 @@
 # keyboards.py
+from functools import lru_cache
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder, InlineKeyboardButton
 from aiogram.types import KeyboardButton
 
 def get_main_keyboard(user_id: int, is_admin: bool = False):
+    # Клавиатура зависит только от прав администратора, поэтому обе версии строятся один раз
+    return _build_main_keyboard(is_admin)
+
+@lru_cache(maxsize=2)
+def _build_main_keyboard(is_admin: bool):
     builder = ReplyKeyboardBuilder()
     buttons = [
         "🔄 Новый чат", "🎙 Ответ голосом",
@@ -22,12 +28,18 @@ def get_main_keyboard(user_id: int, is_admin: bool = False):
     builder.adjust(2)  # Устанавливаем 2 кнопки в строке
     return builder.as_markup(resize_keyboard=True)
 
+@lru_cache(maxsize=1)
 def get_cancel_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.add(KeyboardButton(text="👉 Выход"))
     return builder.as_markup(resize_keyboard=True)
 
 def get_settings_keyboard(current_model: str):
+    # Кнопки настроек не зависят от выбранной модели: клавиатура строится один раз
+    return _build_settings_keyboard()
+
+@lru_cache(maxsize=1)
+def _build_settings_keyboard():
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text="📝 Текстовые модели", callback_data="text_models"))
     builder.add(InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main"))
@@ -35,6 +47,12 @@ def get_settings_keyboard(current_model: str):
     return builder.as_markup()
 
 def get_text_models_keyboard(models: list, current_model: str):
+    # Список моделей меняется редко: клавиатура кэшируется по списку и текущей модели.
+    # После переключения модели администратором ключ меняется сам, сбрасывать кэш не нужно
+    return _build_text_models_keyboard(tuple(models), current_model)
+
+@lru_cache(maxsize=256)
+def _build_text_models_keyboard(models: tuple, current_model: str):
     builder = InlineKeyboardBuilder()
     for model_id, model_name in models:
         text = f"✅ {model_name}" if model_name == current_model else model_name
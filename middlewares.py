@@ -0,0 +1,73 @@
+# middlewares.py
+import asyncio
+import weakref
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class ChatQueueMiddleware(BaseMiddleware):
+    """Обрабатывает обновления одного чата строго по очереди (FIFO),
+    а обновления разных чатов — параллельно.
+
+    Диспетчер запускает каждое обновление отдельной задачей; без этой очереди
+    два сообщения одного пользователя могли бы обрабатываться одновременно.
+    """
+    def __init__(self):
+        # Замок живёт, пока на него ссылается хотя бы одна ожидающая задача
+        self._locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        if chat is None:
+            return await handler(event, data)
+
+        lock = self._locks.get(chat.id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[chat.id] = lock
+        # asyncio.Lock пропускает ожидающих в порядке поступления
+        async with lock:
+            return await handler(event, data)
+
+
+class StateData(dict):
+    """Снимок данных FSM на время обработки одного обновления.
+    Изменения, сделанные через set(), записываются в хранилище одним вызовом после обработчика.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed: Dict[str, Any] = {}
+
+    def set(self, key: str, value: Any):
+        self[key] = value
+        self.changed[key] = value
+
+
+class StateDataMiddleware(BaseMiddleware):
+    """Читает данные FSM один раз до обработчика и передаёт их как `state_data`.
+    Если обработчик что-то изменил, сохраняет изменения одним update_data.
+    """
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        state = data.get("state")
+        if state is None:
+            return await handler(event, data)
+
+        state_data = StateData(await state.get_data())
+        data["state_data"] = state_data
+        try:
+            return await handler(event, data)
+        finally:
+            if state_data.changed:
+                await state.update_data(state_data.changed)
@@ -0,0 +1,84 @@
+# providers.py
+import asyncio
+import logging
+import time
+
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Провайдер временно отключён после серии ошибок."""
+
+
+class ProviderBusyError(Exception):
+    """Очередь запросов к провайдеру переполнена."""
+
+
+class CircuitBreaker:
+    """Размыкает цепь после fail_max ошибок подряд и не пропускает вызовы reset_timeout секунд.
+    По истечении таймаута пропускает один пробный вызов: успех замыкает цепь, ошибка снова размыкает.
+    """
+    def __init__(self, name: str, fail_max: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+
+    def before_call(self):
+        if self._opened_at is None:
+            return
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            raise CircuitOpenError(f"Провайдер {self.name} временно недоступен")
+        # Полуоткрытое состояние: пропускаем пробный вызов, следующий сбой снова разомкнёт цепь
+        self._failures = self.fail_max - 1
+        self._opened_at = None
+
+    def record_success(self):
+        self._failures = 0
+
+    def record_failure(self):
+        self._failures += 1
+        if self._failures >= self.fail_max and self._opened_at is None:
+            self._opened_at = time.monotonic()
+            logger.warning(f"Circuit for provider {self.name} opened for {self.reset_timeout}s")
+
+
+class ProviderGuard:
+    """Обёртка вызовов одного провайдера g4f: ограничение параллельности, короткий повтор и circuit breaker.
+    Повторяется только сам вызов провайдера, а не весь обработчик.
+    Если ожидающих вызовов больше max_queue, новый вызов сразу завершается ProviderBusyError.
+    """
+    def __init__(self, name: str, concurrency: int = 8, max_queue: int = 100, attempts: int = 2,
+                 fail_max: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_pending = concurrency + max_queue
+        self._pending = 0
+        self.breaker = CircuitBreaker(name, fail_max, reset_timeout)
+        self.attempts = attempts
+
+    async def call(self, func, *args, **kwargs):
+        self.breaker.before_call()
+        if self._pending >= self.max_pending:
+            raise ProviderBusyError("Бот перегружен, попробуйте через минуту")
+        self._pending += 1
+        try:
+            async with self.semaphore:
+                try:
+                    async for attempt in AsyncRetrying(
+                        stop=stop_after_attempt(self.attempts),
+                        wait=wait_exponential(multiplier=1, min=1, max=3),
+                        reraise=True,
+                    ):
+                        with attempt:
+                            result = await func(*args, **kwargs)
+                except Exception:
+                    self.breaker.record_failure()
+                    raise
+        finally:
+            self._pending -= 1
+        self.breaker.record_success()
+        return result